@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""
+Replays a recorded samba audit log and reports the lines per second of
+1. the old parsing (regexp with a leading ".*", split, reverse and formatting of the verbose messages per line),
+2. the batched reading and parsing of SambaAuditLog and
+3. the whole processing incl. the bulk requests against the stand-in of elasticsearch.
+
+Run it from the root of the repository: python3 benchmarks/audit_log_replay.py [--audit-log /var/log/samba/audit.log]
+Without --audit-log a log with a typical mix of operations is generated.
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.es_stand_in import ElasticsearchStandIn
+from lib.Fs2EsIndexer import Fs2EsIndexer
+from lib.SambaAuditLog import SambaAuditLog
+
+
+parser = argparse.ArgumentParser(description='Replays a samba audit log and reports the lines per second')
+parser.add_argument('--audit-log', default=None, help='The recorded audit log (default: generate one)')
+parser.add_argument('--lines', type=int, default=500000, help='The amount of lines to generate')
+args = parser.parse_args()
+
+generated_audit_log = None
+audit_log = args.audit_log
+if audit_log is None:
+    random.seed(42)
+    generated_audit_log = tempfile.NamedTemporaryFile('w', prefix='fs2es-indexer-audit-', suffix='.log', delete=False)
+    with generated_audit_log as f:
+        for number in range(args.lines):
+            path = '/srv/samba/projects/customer-%03d/documents/file-%06d.pdf' % (number % 300, number % 50000)
+            prefix = 'Oct 19 10:00:00 fileserver smbd_audit: jdoe|10.0.0.%d|' % (number % 250)
+            chance = random.random()
+            if chance < 0.85:
+                f.write('%sopenat|ok|r|%s\n' % (prefix, path))
+            elif chance < 0.90:
+                f.write('%sopenat|fail (No such file or directory)|r|%s\n' % (prefix, path))
+            elif chance < 0.94:
+                f.write('%sopenat|ok|w|%s\n' % (prefix, path))
+            elif chance < 0.96:
+                f.write('%smkdirat|ok|%s.d\n' % (prefix, path))
+            elif chance < 0.98:
+                f.write('%sopenat|ok|w|%s:com.apple.metadata\n' % (prefix, path))
+            elif chance < 0.9995:
+                f.write('%sunlinkat|ok|%s\n' % (prefix, path))
+            else:
+                f.write('%srenameat|ok|%s|%s.renamed\n' % (prefix, path, path))
+    audit_log = generated_audit_log.name
+
+with open(audit_log, 'r') as f:
+    line_count = sum(1 for _ in f)
+
+Fs2EsIndexer.print('Replaying %s lines of "%s".' % (Fs2EsIndexer.format_count(line_count), audit_log))
+
+indexer = Fs2EsIndexer({'directories': ['/srv/samba']}, False)
+
+
+def parse_old(line):
+    """ The parsing of the audit log lines up to 0.9.1 (without the elasticsearch requests) """
+
+    indexer.print_verbose('* Got new line: "%s"' % line.strip())
+
+    re_match = re.match(r'^.*\|(openat|unlinkat|renameat|mkdirat)\|ok\|(.*)$', line)
+    if re_match:
+        values = re_match.group(2).split('|')
+        values.reverse()
+        if re_match.group(1) == 'openat':
+            openat_operation = values.pop()
+            if openat_operation != 'w':
+                indexer.print_verbose('*- not interested: expected openat with w, but got "%s"' % openat_operation)
+                return None
+
+        return re_match.group(1), values
+
+    indexer.print_verbose('*- not interested: regexp didnt match')
+    return None
+
+
+start_time = time.time()
+with open(audit_log, 'r') as f:
+    old_interesting = 0
+    line = f.readline()
+    while line:
+        if parse_old(line) is not None:
+            old_interesting += 1
+        line = f.readline()
+duration_old = time.time() - start_time
+
+Fs2EsIndexer.print('Old parsing: %.2f sec(s), %.0f lines/s' % (duration_old, line_count / duration_old))
+
+start_time = time.time()
+with open(audit_log, 'r') as f:
+    samba_audit_log = SambaAuditLog(f)
+    new_interesting = 0
+    lines = samba_audit_log.read_lines()
+    while lines:
+        for line in lines:
+            parsed_line = SambaAuditLog.parse_line(line)
+            if parsed_line is not None and (parsed_line[0] != 'openat' or parsed_line[1][0] == 'w'):
+                new_interesting += 1
+        lines = samba_audit_log.read_lines()
+duration_new = time.time() - start_time
+
+assert old_interesting == new_interesting, (old_interesting, new_interesting)
+
+Fs2EsIndexer.print(
+    'Batched parsing: %.2f sec(s), %.0f lines/s (%.1fx)' % (
+        duration_new,
+        line_count / duration_new,
+        duration_old / duration_new
+    )
+)
+
+stand_in = ElasticsearchStandIn().start()
+indexer = Fs2EsIndexer({'directories': ['/srv/samba'], 'elasticsearch': {'url': stand_in.url}}, False)
+
+start_time = time.time()
+with open(audit_log, 'r') as f:
+    samba_audit_log = SambaAuditLog(f)
+    lines = samba_audit_log.read_lines()
+    while lines:
+        indexer.monitor_samba_audit_log_lines(lines)
+        lines = samba_audit_log.read_lines()
+duration_replay = time.time() - start_time
+
+Fs2EsIndexer.print(
+    'Replay incl. elasticsearch: %.2f sec(s), %.0f lines/s, %s request(s), %s document(s) in the index' % (
+        duration_replay,
+        line_count / duration_replay,
+        Fs2EsIndexer.format_count(stand_in.requests),
+        Fs2EsIndexer.format_count(len(stand_in.documents))
+    )
+)
+
+stand_in.stop()
+
+if generated_audit_log is not None:
+    os.unlink(generated_audit_log.name)
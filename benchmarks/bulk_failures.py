@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""
+Imports documents into the stand-in of elasticsearch while it rejects some of them for good (like a mapping error)
+and some temporarily (like an overloaded cluster). Reports the throughput and the dead letters and replays them
+afterwards. Then measures the peak memory of the bulk handling while elasticsearch rejects every document.
+
+Run it from the root of the repository: python3 benchmarks/bulk_failures.py [--documents 500000]
+"""
+
+import argparse
+import contextlib
+import glob
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.es_stand_in import ElasticsearchStandIn
+from lib.Fs2EsIndexer import Fs2EsIndexer
+
+
+parser = argparse.ArgumentParser(description='Benchmarks the handling of rejected documents in the bulk requests')
+parser.add_argument('--documents', type=int, default=500000, help='The amount of documents to import')
+parser.add_argument('--rejected', type=float, default=0.01, help='The share of documents rejected for good')
+parser.add_argument('--overloaded', type=float, default=0.05, help='The share of documents rejected once with 429')
+args = parser.parse_args()
+
+dead_letters_directory = tempfile.mkdtemp(prefix='fs2es-indexer-dead-letters-')
+dead_letters_file = os.path.join(dead_letters_directory, 'dead-letters.ndjson')
+
+stand_in = ElasticsearchStandIn().start()
+indexer = Fs2EsIndexer(
+    {
+        'directories': ['/srv/samba'],
+        'elasticsearch': {
+            'url': stand_in.url,
+            'bulk_size': 10000,
+            'bulk_retry_wait': 0.1,
+            'dead_letters': {'file': dead_letters_file, 'max_size': 1, 'backup_count': 3},
+        },
+    },
+    False
+)
+
+rejected_every = max(1, int(1 / args.rejected))
+overloaded_every = max(1, int(1 / args.overloaded))
+overloaded_seen = set()
+
+
+def reject(op_type, document_id, body):
+    if stand_in.rejecting_all:
+        return 400, {"type": "mapper_parsing_exception", "reason": "failed to parse field [file.filename]"}
+
+    number = int(body['file']['filename'].split('-')[1].split('.')[0])
+    if stand_in.rejecting and number % rejected_every == 0:
+        return 400, {"type": "mapper_parsing_exception", "reason": "failed to parse field [file.filename]"}
+
+    if number % overloaded_every == 1 and document_id not in overloaded_seen:
+        overloaded_seen.add(document_id)
+        return 429, {"type": "es_rejected_execution_exception", "reason": "rejected execution"}
+
+    return None
+
+
+stand_in.rejecting = True
+stand_in.rejecting_all = False
+stand_in.reject = reject
+
+
+def documents():
+    for number in range(args.documents):
+        path = '/srv/samba/projects/customer-%03d/file-%07d.pdf' % (number % 500, number)
+        yield indexer.elasticsearch_map_path_to_document(path=path, filename=os.path.basename(path))
+
+
+start_time = time.time()
+with contextlib.redirect_stdout(io.StringIO()):
+    indexer.elasticsearch_bulk_action(documents())
+duration = time.time() - start_time
+
+dead_letter_files = sorted(glob.glob(dead_letters_file + '*'))
+Fs2EsIndexer.print(
+    'Import: %.2f sec(s), %.0f documents/s, %s written, %s failed' % (
+        duration,
+        args.documents / duration,
+        Fs2EsIndexer.format_count(indexer.elasticsearch_documents_written),
+        Fs2EsIndexer.format_count(indexer.elasticsearch_documents_failed)
+    )
+)
+Fs2EsIndexer.print(
+    'Dead letters: %d file(s), %.1f MiB' % (
+        len(dead_letter_files),
+        sum(os.path.getsize(path) for path in dead_letter_files) / 1024 / 1024
+    )
+)
+
+stand_in.rejecting = False
+indexer.elasticsearch_reset_stats()
+start_time = time.time()
+with contextlib.redirect_stdout(io.StringIO()):
+    indexer.elasticsearch_replay_dead_letters()
+
+Fs2EsIndexer.print(
+    'Replay: %.2f sec(s), %s written, %s failed, %s document(s) in the index' % (
+        time.time() - start_time,
+        Fs2EsIndexer.format_count(indexer.elasticsearch_documents_written),
+        Fs2EsIndexer.format_count(indexer.elasticsearch_documents_failed),
+        Fs2EsIndexer.format_count(len(stand_in.documents))
+    )
+)
+
+# Everything fails: neither the memory nor the dead letter files may grow with the amount of documents
+stand_in.rejecting_all = True
+indexer.elasticsearch_reset_stats()
+tracemalloc.start()
+with contextlib.redirect_stdout(io.StringIO()):
+    indexer.elasticsearch_bulk_action(documents())
+memory_peak = tracemalloc.get_traced_memory()[1]
+tracemalloc.stop()
+
+dead_letter_files = sorted(glob.glob(dead_letters_file + '*'))
+Fs2EsIndexer.print(
+    'Everything rejected: %s failed, peak memory %.1f MiB, dead letters: %d file(s), %.1f MiB' % (
+        Fs2EsIndexer.format_count(indexer.elasticsearch_documents_failed),
+        memory_peak / 1024 / 1024,
+        len(dead_letter_files),
+        sum(os.path.getsize(path) for path in dead_letter_files) / 1024 / 1024
+    )
+)
+
+stand_in.stop()
+for path in glob.glob(dead_letters_file + '*'):
+    os.unlink(path)
+os.rmdir(dead_letters_directory)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""
+Benchmarks the transport settings (compression, multiple nodes, bulk workers) for the bulk import against two
+stand-ins of elasticsearch: bytes on the wire and documents per second.
+
+Run it from the root of the repository: python3 benchmarks/bulk_transport.py [--documents 200000]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.es_stand_in import ElasticsearchStandIn
+from lib.Fs2EsIndexer import Fs2EsIndexer
+
+
+parser = argparse.ArgumentParser(description='Benchmarks the transport settings for the bulk import')
+parser.add_argument('--documents', type=int, default=200000, help='The amount of documents to import')
+args = parser.parse_args()
+
+# Realistic paths: deep, with a lot of repetition
+paths = [
+    '/srv/samba/projects/customer-%03d/2024/drawings/revision-%02d/Building_Plan_Floor_%04d.pdf' % (
+        number % 500,
+        number % 17,
+        number
+    )
+    for number in range(args.documents)
+]
+
+configurations = [
+    ('1 node, uncompressed', 1, {}),
+    ('1 node, gzip', 1, {'compress': True}),
+    ('2 nodes (round robin), gzip', 2, {'compress': True}),
+    ('2 nodes (round robin), gzip, 4 bulk workers', 2, {'compress': True, 'bulk_workers': 4}),
+]
+
+for name, node_count, transport_config in configurations:
+    stand_ins = [ElasticsearchStandIn().start() for _ in range(node_count)]
+
+    indexer = Fs2EsIndexer(
+        {
+            'directories': ['/srv/samba'],
+            'elasticsearch': {
+                'url': [stand_in.url for stand_in in stand_ins],
+                'bulk_size': 10000,
+                'transport': transport_config,
+            },
+        },
+        False
+    )
+
+    start_time = time.time()
+    indexer.elasticsearch_live_update(paths, [])
+    duration = time.time() - start_time
+
+    documents = sum(len(stand_in.documents) for stand_in in stand_ins)
+    assert documents == len(paths), documents
+
+    Fs2EsIndexer.print(
+        '%s: %.2f MiB on the wire in %d request(s), %.2f sec(s), %.0f documents/s' % (
+            name,
+            sum(stand_in.bytes_received for stand_in in stand_ins) / 1024 / 1024,
+            sum(stand_in.requests for stand_in in stand_ins),
+            duration,
+            len(paths) / duration
+        )
+    )
+    for node_summary in indexer.elasticsearch_node_stats.summary():
+        Fs2EsIndexer.print('- %s' % node_summary)
+
+    for stand_in in stand_ins:
+        stand_in.stop()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""
+Measures the startup of the command line tool via "python3 -X importtime" and fails if
+1. an action which doesn't talk to elasticsearch ("--help", "control") imports the elasticsearch library or
+2. the imports of such an action take longer than --max-import-ms.
+
+For comparison the import time of the elasticsearch library itself (which the other actions pay on their first
+request) is reported, too.
+
+Run it from the root of the repository: python3 benchmarks/cli_startup.py [--max-import-ms 150]
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository)
+
+from lib.Fs2EsIndexer import Fs2EsIndexer
+
+
+parser = argparse.ArgumentParser(description='Measures the import time of the command line tool per action')
+parser.add_argument('--runs', type=int, default=5, help='The amount of runs per action (the fastest one counts)')
+parser.add_argument('--max-import-ms', type=float, default=150, help='Fail if an action imports longer than this')
+args = parser.parse_args()
+
+config_file = tempfile.NamedTemporaryFile('w', prefix='fs2es-indexer-config-', suffix='.yml', delete=False)
+with config_file as f:
+    f.write('directories:\n  - "/srv/samba"\ncontrol_socket: "%s.sock"\n' % config_file.name)
+
+light_actions = {
+    '--help': ['--help'],
+    'control': ['control', '--config', config_file.name],
+}
+
+
+def measure(arguments):
+    """ Runs python3 -X importtime with the arguments and returns the wall time, the import time and the modules """
+
+    start_time = time.time()
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + arguments,
+        cwd=repository,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+    duration = time.time() - start_time
+
+    import_us = 0
+    modules = set()
+    for line in process.stderr.splitlines():
+        re_match = re.match(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$', line)
+        if re_match:
+            modules.add(re_match.group(4))
+            # Only the top level imports, the cumulative time contains the nested ones
+            if re_match.group(3) == ' ':
+                import_us += int(re_match.group(2))
+
+    return duration, import_us / 1000, modules
+
+
+failed = False
+
+_, baseline_ms, baseline_modules = min(
+    [measure(['-c', 'pass']) for _ in range(args.runs)],
+    key=lambda result: result[1]
+)
+Fs2EsIndexer.print('Interpreter without the indexer: %.1f ms imports' % baseline_ms)
+
+for name, arguments in light_actions.items():
+    results = [measure(['fs2es-indexer'] + arguments) for _ in range(args.runs)]
+    duration, import_ms, modules = min(results, key=lambda result: result[1])
+    import_ms -= baseline_ms
+
+    elasticsearch_modules = sorted(module for module in modules if module.split('.')[0] == 'elasticsearch')
+
+    Fs2EsIndexer.print(
+        'Action "%s": %.1f ms wall time, %.1f ms imports (on top of the interpreter), %d module(s)%s' % (
+            name,
+            duration * 1000,
+            import_ms,
+            len(modules - baseline_modules),
+            ', imports elasticsearch!' if elasticsearch_modules else ''
+        )
+    )
+
+    if elasticsearch_modules or import_ms > args.max_import_ms:
+        failed = True
+
+_, elasticsearch_ms, _ = min(
+    [measure(['-c', 'import elasticsearch, elasticsearch.helpers']) for _ in range(args.runs)],
+    key=lambda result: result[1]
+)
+Fs2EsIndexer.print(
+    'The elasticsearch library (imported on the first request): %.1f ms' % (elasticsearch_ms - baseline_ms)
+)
+
+os.unlink(config_file.name)
+
+if failed:
+    Fs2EsIndexer.print_error('An action without elasticsearch requests imports too much, see above.')
+    exit(1)
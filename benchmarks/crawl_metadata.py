@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""
+Benchmarks how much the additional fields (filesize, last_modified) add to an indexing run against the stand-in of
+elasticsearch. Crawls a generated directory tree with and without the additional fields.
+
+Run it from the root of the repository: python3 benchmarks/crawl_metadata.py [--files 200000]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.es_stand_in import ElasticsearchStandIn
+from lib.Fs2EsIndexer import Fs2EsIndexer
+
+
+parser = argparse.ArgumentParser(description='Benchmarks the crawl with and without the additional fields')
+parser.add_argument('--files', type=int, default=200000, help='The amount of files in the generated tree')
+parser.add_argument('--changed', type=float, default=0.01, help='The share of files changed before the last run')
+parser.add_argument('--directory', default=None, help='Where to generate the tree (default: a temporary directory)')
+args = parser.parse_args()
+
+tree = tempfile.mkdtemp(prefix='fs2es-indexer-benchmark-', dir=args.directory)
+files = []
+for directory_number in range(max(1, args.files // 1000)):
+    directory = os.path.join(tree, 'dir-%04d' % directory_number)
+    os.mkdir(directory)
+    for file_number in range(min(1000, args.files)):
+        path = os.path.join(directory, 'file-%04d.pdf' % file_number)
+        with open(path, 'w') as f:
+            f.write('x')
+        files.append(path)
+
+Fs2EsIndexer.print('Generated %s files in "%s".' % (Fs2EsIndexer.format_count(len(files)), tree))
+
+
+def indexing_run(indexer):
+    """ Runs index_directories() quietly and returns (run duration, elasticsearch duration) """
+
+    start_time = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        indexer.index_directories()
+
+    return time.time() - start_time, indexer.duration_elasticsearch
+
+
+try:
+    for add_additional_fields in (False, True):
+        stand_in = ElasticsearchStandIn().start()
+        indexer = Fs2EsIndexer(
+            {
+                'directories': [tree],
+                'elasticsearch': {
+                    'url': stand_in.url,
+                    'bulk_size': 10000,
+                    'add_additional_fields': add_additional_fields
+                },
+            },
+            False
+        )
+
+        results = [('initial run', indexing_run(indexer)), ('unchanged run', indexing_run(indexer))]
+
+        # Change the size of some files
+        for path in files[::max(1, int(1 / args.changed))]:
+            with open(path, 'a') as f:
+                f.write('y')
+
+        results.append(('run with %.1f%% changed' % (args.changed * 100), indexing_run(indexer)))
+
+        for name, (duration, duration_elasticsearch) in results:
+            Fs2EsIndexer.print(
+                'add_additional_fields=%s, %s: %.2f sec(s) total, %.2f sec(s) crawl, %.2f sec(s) elasticsearch' % (
+                    add_additional_fields,
+                    name,
+                    duration,
+                    duration - duration_elasticsearch,
+                    duration_elasticsearch
+                )
+            )
+
+        stand_in.stop()
+finally:
+    shutil.rmtree(tree)
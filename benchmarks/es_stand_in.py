@@ -0,0 +1,313 @@
+#-*- coding: utf-8 -*-
+
+"""
+A tiny in-memory stand-in for the parts of the elasticsearch REST API the indexer uses.
+
+Only meant for the benchmarks: it measures the client side (serialization, requests, bookkeeping) of the indexer
+without the noise of a real elasticsearch instance. Never use it for anything else.
+"""
+
+import gzip
+import http.server
+import itertools
+import json
+import threading
+import urllib.parse
+
+
+class ElasticsearchStandIn(object):
+    """ Holds the documents and serves them via HTTP in a background thread """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.documents = {}
+        self.scrolls = {}
+        self.scroll_ids = itertools.count()
+        self.lock = threading.Lock()
+
+        # Statistics of the received requests (bytes as sent over the wire, i. e. compressed)
+        self.requests = 0
+        self.bytes_received = 0
+
+        # Optional callable(op_type, document_id, body) returning (status, error) to reject a bulk action
+        self.reject = None
+
+        stand_in = self
+
+        class RequestHandler(StandInRequestHandler):
+            server_stand_in = stand_in
+
+        self.server = http.server.ThreadingHTTPServer((host, port), RequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server.server_address
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def matches(self, query, document_id, document):
+        """ Evaluates the subset of the query DSL the indexer uses """
+
+        if query is None or 'match_all' in query:
+            return True
+
+        if 'bool' in query:
+            return any(self.matches(should, document_id, document) for should in query['bool'].get('should', []))
+
+        if 'terms' in query:
+            return document_id in query['terms']['_id']
+
+        path = document.get('path', {}).get('real', '')
+        if 'term' in query:
+            return path == query['term']['path.real']
+
+        if 'prefix' in query:
+            return path.startswith(query['prefix']['path.real'])
+
+        raise ValueError('Unsupported query: %s' % json.dumps(query))
+
+    def search(self, body, params):
+        """ Starts a (scrolled) search """
+
+        query = body.get('query')
+        size = int(params.get('size', body.get('size', 10)))
+
+        if query is not None and 'ids' in query:
+            # Look the IDs up directly instead of testing every document
+            with self.lock:
+                hits = [
+                    (document_id, self.documents[document_id])
+                    for document_id in query['ids']['values']
+                    if document_id in self.documents
+                ]
+
+            return self.page(hits, size, body.get('_source', True), 'scroll' in params)
+
+        with self.lock:
+            hits = [
+                (document_id, document)
+                for document_id, document in self.documents.items()
+                if self.matches(query, document_id, document)
+            ]
+
+        return self.page(hits, size, body.get('_source', True), 'scroll' in params)
+
+    def page(self, hits, size, source, scroll):
+        """ Returns the next page of hits and keeps the rest for the next scroll request """
+
+        response_hits = []
+        for document_id, document in hits[:size]:
+            hit = {"_index": "files", "_id": document_id}
+            if source is True:
+                hit['_source'] = document
+            elif source:
+                hit['_source'] = filter_source(document, source)
+            response_hits.append(hit)
+
+        response = {
+            "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+            "hits": {
+                "total": {"value": len(hits), "relation": "eq"},
+                "hits": response_hits
+            }
+        }
+
+        if scroll:
+            scroll_id = str(next(self.scroll_ids))
+            self.scrolls[scroll_id] = (hits[size:], size, source)
+            response['_scroll_id'] = scroll_id
+
+        return response
+
+    def scroll(self, body):
+        hits, size, source = self.scrolls.pop(body['scroll_id'])
+        return self.page(hits, size, source, True)
+
+    def bulk(self, data):
+        """ Executes the bulk request """
+
+        items = []
+        lines = data.splitlines()
+        line_index = 0
+        with self.lock:
+            while line_index < len(lines):
+                if not lines[line_index].strip():
+                    line_index += 1
+                    continue
+
+                action = json.loads(lines[line_index])
+                line_index += 1
+
+                op_type, meta = next(iter(action.items()))
+                document_id = meta.get('_id')
+                status = 200
+
+                body = None
+                if op_type != 'delete':
+                    body = json.loads(lines[line_index])
+
+                rejection = self.reject(op_type, document_id, body) if self.reject is not None else None
+                if rejection is not None:
+                    if body is not None:
+                        line_index += 1
+
+                    status, error = rejection
+                    items.append({op_type: {"_id": document_id, "status": status, "error": error}})
+                    continue
+
+                if op_type in ('index', 'create'):
+                    status = 200 if document_id in self.documents else 201
+                    self.documents[document_id] = body
+                    line_index += 1
+                elif op_type == 'update':
+                    update = body
+                    line_index += 1
+                    if document_id in self.documents:
+                        merge(self.documents[document_id], update.get('doc', {}))
+                    else:
+                        status = 404
+                elif op_type == 'delete':
+                    status = 200 if self.documents.pop(document_id, None) is not None else 404
+
+                item = {"_index": meta.get('_index', 'files'), "_id": document_id, "status": status}
+                if status == 404 and op_type == 'update':
+                    item['error'] = {"type": "document_missing_exception", "reason": "document missing"}
+                items.append({op_type: item})
+
+        return {
+            "took": 0,
+            "errors": any('error' in item[next(iter(item))] for item in items),
+            "items": items
+        }
+
+    def delete_by_query(self, body):
+        query = body.get('query')
+        with self.lock:
+            document_ids = [
+                document_id
+                for document_id, document in self.documents.items()
+                if self.matches(query, document_id, document)
+            ]
+            for document_id in document_ids:
+                del self.documents[document_id]
+
+        return {"deleted": len(document_ids)}
+
+
+def filter_source(document, fields):
+    """ Returns only the given (dotted) fields of the document """
+
+    filtered = {}
+    for field in fields:
+        value = document
+        for key in field.split('.'):
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            target = filtered
+            keys = field.split('.')
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = value
+
+    return filtered
+
+
+def merge(target, update):
+    """ Merges a partial document into a document like elasticsearch does it for updates """
+
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge(target[key], value)
+        else:
+            target[key] = value
+
+
+class StandInRequestHandler(http.server.BaseHTTPRequestHandler):
+    """ Routes the HTTP requests to the stand-in """
+
+    protocol_version = 'HTTP/1.1'
+    # Otherwise the delayed ACKs dominate the measurements
+    disable_nagle_algorithm = True
+    server_stand_in = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_HEAD(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def do_PUT(self):
+        self.handle_request()
+
+    def do_DELETE(self):
+        self.handle_request()
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length) if length > 0 else b''
+
+        self.server_stand_in.requests += 1
+        self.server_stand_in.bytes_received += len(data)
+
+        if self.headers.get('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+
+        return data
+
+    def handle_request(self):
+        stand_in = self.server_stand_in
+        data = self.read_body()
+
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        parts = [part for part in url.path.split('/') if part]
+
+        status = 200
+        if not parts:
+            response = {"version": {"number": "8.19.0", "build_flavor": "default"}, "tagline": "You Know, for Search"}
+        elif parts[-1] == '_bulk':
+            response = stand_in.bulk(data.decode('utf-8'))
+        elif parts == ['_search', 'scroll']:
+            if self.command == 'DELETE':
+                response = {"succeeded": True, "num_freed": 1}
+            else:
+                response = stand_in.scroll(json.loads(data))
+        elif parts[-1] == '_search':
+            response = stand_in.search(json.loads(data) if data else {}, params)
+        elif parts[-1] == '_delete_by_query':
+            response = stand_in.delete_by_query(json.loads(data))
+        elif len(parts) == 3 and parts[1] == '_doc' and self.command == 'DELETE':
+            with stand_in.lock:
+                found = stand_in.documents.pop(parts[2], None) is not None
+            status = 200 if found else 404
+            response = {"_id": parts[2], "result": "deleted" if found else "not_found"}
+        elif parts[-1] == '_refresh':
+            response = {"_shards": {"total": 1, "successful": 1, "failed": 0}}
+        else:
+            status = 404
+            response = {"error": {"type": "unsupported", "reason": self.path}, "status": 404}
+
+        body = json.dumps(response).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if self.command != 'HEAD':
+            self.wfile.write(body)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""
+Benchmarks the action "plan" against a real indexing run on a generated directory tree with some new, deleted and
+excluded paths. Both run against the stand-in of elasticsearch and must agree on the counts.
+
+Run it from the root of the repository: python3 benchmarks/plan_dry_run.py [--files 200000]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.es_stand_in import ElasticsearchStandIn
+from lib.Fs2EsIndexer import Fs2EsIndexer
+
+
+parser = argparse.ArgumentParser(description='Benchmarks the action "plan" against a real indexing run')
+parser.add_argument('--files', type=int, default=200000, help='The amount of files in the generated tree')
+parser.add_argument('--changed', type=float, default=0.05, help='The share of files added and deleted before the run')
+parser.add_argument('--directory', default=None, help='Where to generate the tree (default: a temporary directory)')
+args = parser.parse_args()
+
+tree = tempfile.mkdtemp(prefix='fs2es-indexer-benchmark-', dir=args.directory)
+files = []
+for directory_number in range(max(1, args.files // 1000)):
+    directory = os.path.join(tree, 'dir-%04d' % directory_number)
+    os.mkdir(directory)
+    for file_number in range(min(1000, args.files)):
+        path = os.path.join(directory, 'file-%04d.pdf' % file_number)
+        open(path, 'w').close()
+        files.append(path)
+
+Fs2EsIndexer.print('Generated %s files in "%s".' % (Fs2EsIndexer.format_count(len(files)), tree))
+
+stand_in = ElasticsearchStandIn().start()
+config = {
+    'directories': [tree],
+    'exclusions': {'partial_paths': ['.tmp']},
+    'elasticsearch': {'url': stand_in.url, 'bulk_size': 10000},
+}
+
+try:
+    indexer = Fs2EsIndexer(config, False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        indexer.elasticsearch_get_all_ids()
+        indexer.index_directories()
+
+    # Delete some files, add others and some which are excluded
+    step = max(1, int(1 / args.changed))
+    for path in files[::step]:
+        os.unlink(path)
+        open(path + '.new', 'w').close()
+        open(path + '.tmp', 'w').close()
+
+    plan_file = tree + '-plan.txt'
+    indexer = Fs2EsIndexer(config, False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        indexer.elasticsearch_get_all_ids()
+
+    documents_before = len(stand_in.documents)
+    requests_before = stand_in.requests
+    start_time = time.time()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        indexer.plan(plan_file)
+    duration_plan = time.time() - start_time
+    requests_plan = stand_in.requests - requests_before
+
+    assert len(stand_in.documents) == documents_before, 'plan wrote documents'
+
+    with open(plan_file, 'r') as f:
+        plan_lines = sum(1 for _ in f)
+    os.unlink(plan_file)
+
+    # plan() used up the document IDs
+    with contextlib.redirect_stdout(io.StringIO()):
+        indexer.elasticsearch_get_all_ids()
+
+    requests_before = stand_in.requests
+    start_time = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        indexer.index_directories()
+    duration_index = time.time() - start_time
+
+    print(output.getvalue().split('Plan (')[1].split('\n', 1)[1], end='')
+
+    # The same amount of files got added and deleted
+    assert len(stand_in.documents) == documents_before, len(stand_in.documents)
+    assert plan_lines == 2 * len(files[::step]), plan_lines
+
+    Fs2EsIndexer.print(
+        'plan: %.2f sec(s), %d request(s); index: %.2f sec(s), %d request(s)' % (
+            duration_plan,
+            requests_plan,
+            duration_index,
+            stand_in.requests - requests_before
+        )
+    )
+finally:
+    stand_in.stop()
+    shutil.rmtree(tree)
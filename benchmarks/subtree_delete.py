@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""
+Benchmarks the deletion of a whole directory tree from the index against the stand-in of elasticsearch:
+the streamed bulk deletes driven by a prefix query vs. deleting one document at a time.
+
+Run it from the root of the repository: python3 benchmarks/subtree_delete.py [--entries 100000]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.es_stand_in import ElasticsearchStandIn
+from lib.Fs2EsIndexer import Fs2EsIndexer
+
+
+parser = argparse.ArgumentParser(description='Benchmarks the deletion of a directory tree from the index')
+parser.add_argument('--entries', type=int, default=100000, help='The amount of documents in the deleted tree')
+parser.add_argument('--sample', type=int, default=2000, help='The amount of single deletes to extrapolate from')
+args = parser.parse_args()
+
+stand_in = ElasticsearchStandIn().start()
+
+indexer = Fs2EsIndexer(
+    {
+        'directories': ['/srv/share'],
+        'elasticsearch': {'url': stand_in.url, 'bulk_size': 10000},
+    },
+    False
+)
+
+# 100 directories with (entries / 100) files each and some documents outside of the tree which must survive
+tree = '/srv/share/tree'
+paths = [tree]
+for directory_number in range(100):
+    directory = '%s/dir-%03d' % (tree, directory_number)
+    paths.append(directory)
+    paths.extend('%s/file-%06d.pdf' % (directory, file_number) for file_number in range(args.entries // 100 - 1))
+paths_outside = ['/srv/share/tree-sibling/file-%06d.pdf' % file_number for file_number in range(10000)]
+
+indexer.elasticsearch_live_update(paths + paths_outside, [])
+Fs2EsIndexer.print('Loaded %s documents into the stand-in.' % Fs2EsIndexer.format_count(len(stand_in.documents)))
+
+start_time = time.time()
+documents_deleted = indexer.elasticsearch_delete_subtree(tree)
+duration_subtree = time.time() - start_time
+
+assert documents_deleted == len(paths), documents_deleted
+assert len(stand_in.documents) == len(paths_outside)
+assert len(indexer.elasticsearch_document_ids) == len(paths_outside)
+
+Fs2EsIndexer.print(
+    'Subtree delete: %s documents in %.2f sec(s) (%.0f documents/s)' % (
+        Fs2EsIndexer.format_count(documents_deleted),
+        duration_subtree,
+        documents_deleted / duration_subtree
+    )
+)
+
+# The old way: one request per document
+sample = paths_outside[:args.sample]
+start_time = time.time()
+for path in sample:
+    indexer.elasticsearch.delete(index=indexer.elasticsearch_index, id=indexer.elasticsearch_map_path_to_id(path))
+duration_single = (time.time() - start_time) / len(sample) * documents_deleted
+
+Fs2EsIndexer.print(
+    'Single deletes: %s documents would take %.2f sec(s) (extrapolated from %s deletes)' % (
+        Fs2EsIndexer.format_count(documents_deleted),
+        duration_single,
+        Fs2EsIndexer.format_count(len(sample))
+    )
+)
+
+stand_in.stop()
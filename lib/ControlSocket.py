@@ -0,0 +1,101 @@
+#-*- coding: utf-8 -*-
+
+import os
+import select
+import socket
+
+
+class ControlSocket(object):
+    """
+    A local UNIX socket to control the daemon, e. g. via "fs2es-indexer control --command stats".
+
+    Each connection sends exactly one command line and gets one response back. The socket is polled by the daemon
+    itself, so the commands are executed in between its regular work.
+    """
+
+    def __init__(self, path, handler):
+        """ Constructor, handler(command, arguments) executes the command and returns the response text """
+
+        self.path = path
+        self.handler = handler
+
+        if os.path.exists(self.path):
+            # Left over from a previous (crashed) daemon
+            os.unlink(self.path)
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(self.path)
+        # Only the owner (root) may control the daemon
+        os.chmod(self.path, 0o600)
+        self.socket.listen(5)
+        self.socket.setblocking(False)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def close(self):
+        self.socket.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def poll(self, timeout=0):
+        """ Handles the pending connections, waits up to timeout seconds for a new one """
+
+        readable, _, _ = select.select([self.socket], [], [], timeout)
+        while readable:
+            try:
+                connection, _ = self.socket.accept()
+            except BlockingIOError:
+                break
+
+            with connection:
+                self.handle_connection(connection)
+
+    def handle_connection(self, connection):
+        """ Reads one command from the connection and writes the response """
+
+        connection.settimeout(5)
+
+        request = b''
+        try:
+            while b'\n' not in request and len(request) < 65536:
+                data = connection.recv(4096)
+                if not data:
+                    break
+                request += data
+        except OSError:
+            return
+
+        command_line = request.decode('utf-8', 'surrogateescape').strip()
+        command, _, arguments = command_line.partition(' ')
+
+        try:
+            response = self.handler(command, arguments.strip())
+        except Exception as err:
+            response = 'Error: %s' % str(err)
+
+        try:
+            connection.sendall((response + '\n').encode('utf-8', 'surrogateescape'))
+        except OSError:
+            pass
+
+    @staticmethod
+    def send_command(path, command_line, timeout=None):
+        """ Sends a command to the control socket of a running daemon and returns its response """
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(timeout)
+            client.connect(path)
+            client.sendall((command_line + '\n').encode('utf-8', 'surrogateescape'))
+            client.shutdown(socket.SHUT_WR)
+
+            response = b''
+            while True:
+                data = client.recv(4096)
+                if not data:
+                    break
+                response += data
+
+        return response.decode('utf-8', 'surrogateescape').rstrip('\n')
@@ -0,0 +1,167 @@
+#-*- coding: utf-8 -*-
+
+import os
+import re
+import time
+
+
+class CrawlScheduler(object):
+    """
+    Decides when each of the directories is crawled in the "daemon" mode.
+
+    Every directory has its own wait time between crawls and a priority: if several directories are due, the ones with
+    the higher priority are crawled first. A directory can be marked as dirty (e. g. by the samba audit log) to crawl it
+    after its "dirty_wait_time" already, or forced (e. g. after an overflow of the watcher) to crawl it right away.
+    """
+
+    def __init__(self, directories_config, scheduler_config, default_wait_seconds):
+        """ Constructor, raises a ValueError on an invalid configuration """
+
+        self.max_concurrent_crawls = scheduler_config.get('max_concurrent_crawls', 1)
+        if not isinstance(self.max_concurrent_crawls, int) or self.max_concurrent_crawls < 1:
+            raise ValueError(
+                'Invalid "max_concurrent_crawls": %s, expected a number >= 1' % self.max_concurrent_crawls
+            )
+
+        # The paths in the configured order and their schedules
+        self.paths = []
+        self.schedules = {}
+
+        # Either the path or a dict with "path" and the options of this directory
+        for directory_config in directories_config or []:
+            if not isinstance(directory_config, dict):
+                directory_config = {'path': directory_config}
+
+            path = directory_config.get('path', None)
+            if not path:
+                raise ValueError('Every entry of "directories" needs a "path"')
+
+            dirty_wait_time = directory_config.get('dirty_wait_time', None)
+
+            self.paths.append(path)
+            self.schedules[path] = {
+                'prefix': path.rstrip(os.sep) + os.sep,
+                'wait_seconds': self.parse_wait_time(
+                    directory_config['wait_time'], 'wait_time'
+                ) if 'wait_time' in directory_config else default_wait_seconds,
+                'priority': directory_config.get('priority', 0),
+                'dirty_wait_seconds': self.parse_wait_time(
+                    dirty_wait_time, 'dirty_wait_time'
+                ) if dirty_wait_time is not None else None,
+                'crawled_at': None,
+                'dirty': False,
+                'forced': False,
+            }
+
+    @staticmethod
+    def parse_wait_time(wait_time, name):
+        """ Parses a wait time like "30m" into seconds """
+
+        re_match = re.match(r'^(\d+)(\w)$', str(wait_time))
+        if not re_match:
+            raise ValueError('Unknown "%s": %s' % (name, wait_time))
+
+        suffix = re_match.group(2)
+        if suffix == 's':
+            return int(re_match.group(1))
+        elif suffix == 'm':
+            return int(re_match.group(1)) * 60
+        elif suffix == 'h':
+            return int(re_match.group(1)) * 60 * 60
+        elif suffix == 'd':
+            return int(re_match.group(1)) * 60 * 60 * 24
+
+        raise ValueError('Unknown time unit in "%s": %s, expected "s", "m", "h" or "d"' % (name, suffix))
+
+    def directory_of(self, path):
+        """ Returns the configured directory containing path (or being path) or None """
+
+        for directory in self.paths:
+            if path == directory or path.startswith(self.schedules[directory]['prefix']):
+                return directory
+
+        return None
+
+    def mark_dirty(self, path, force=False):
+        """ Marks the directory containing path as changed, force crawls it as soon as possible """
+
+        directory = self.directory_of(path)
+        if directory is None:
+            return
+
+        schedule = self.schedules[directory]
+        schedule['dirty'] = True
+        if force:
+            schedule['forced'] = True
+
+    def request_all(self):
+        """ Crawls all directories as soon as possible, e. g. for the command "run" of the control socket """
+
+        for schedule in self.schedules.values():
+            schedule['forced'] = True
+
+    def crawled(self, directory, crawled_at=None):
+        """ Records the end of a crawl of the directory """
+
+        schedule = self.schedules[directory]
+        schedule['crawled_at'] = time.time() if crawled_at is None else crawled_at
+        schedule['dirty'] = False
+        schedule['forced'] = False
+
+    def crawled_all(self):
+        """ Records the end of a complete indexing run """
+
+        crawled_at = time.time()
+        for directory in self.paths:
+            self.crawled(directory, crawled_at)
+
+    def crawl_at(self, directory):
+        """ Returns the time when the directory is due """
+
+        schedule = self.schedules[directory]
+        if schedule['forced'] or schedule['crawled_at'] is None:
+            return 0
+
+        crawl_at = schedule['crawled_at'] + schedule['wait_seconds']
+        if schedule['dirty'] and schedule['dirty_wait_seconds'] is not None:
+            crawl_at = min(crawl_at, schedule['crawled_at'] + schedule['dirty_wait_seconds'])
+
+        return crawl_at
+
+    def next_crawl_at(self):
+        """ Returns the time when the next directory is due """
+
+        return min([self.crawl_at(directory) for directory in self.paths], default=float('inf'))
+
+    def due_directories(self, excluded_directories=()):
+        """ Returns the due directories, the highest priority and the longest overdue first """
+
+        now = time.time()
+        due_directories = [
+            directory
+            for directory in self.paths
+            if directory not in excluded_directories and self.crawl_at(directory) <= now
+        ]
+
+        return sorted(
+            due_directories,
+            key=lambda directory: (-self.schedules[directory]['priority'], self.crawl_at(directory))
+        )
+
+    def summary(self):
+        """ Returns one line per directory """
+
+        now = time.time()
+        summary = []
+        for directory in self.paths:
+            schedule = self.schedules[directory]
+            summary.append(
+                '"%s": priority %s, next crawl in %.1f min(s)%s' % (
+                    directory,
+                    schedule['priority'],
+                    max(0, self.crawl_at(directory) - now) / 60,
+                    ', dirty' if schedule['dirty'] else ''
+                )
+            )
+
+        return summary
@@ -0,0 +1,185 @@
+#-*- coding: utf-8 -*-
+
+import re
+import threading
+import time
+
+
+class CrawlThrottle(object):
+    """
+    Limits the rate of directory listings of the crawler so that it doesn't compete with the Samba clients for the
+    metadata IOPS of the storage.
+
+    Supports a token bucket with a fixed rate, an adaptive mode which backs off when the listings get slow and
+    time-of-day profiles which override both settings.
+    """
+
+    def __init__(self, config):
+        """ Constructor, raises a ValueError on an invalid configuration """
+
+        self.default_profile = self.parse_profile(config)
+        self.burst = max(1, config.get('burst', 10))
+        self.target_latency = config.get('target_latency', 0.05)
+        self.min_listings_per_second = config.get('min_listings_per_second', 5)
+
+        self.profiles = []
+        for profile in config.get('profiles', []):
+            self.profiles.append((
+                self.parse_time_of_day(profile.get('from', '00:00')),
+                self.parse_time_of_day(profile.get('to', '24:00')),
+                self.parse_profile(profile, self.default_profile)
+            ))
+
+        self.active_profile = None
+        self.profile_checked_at = 0
+        self.max_rate = 0
+        self.adaptive = False
+        self.rate = 0
+
+        self.tokens = self.burst
+        self.tokens_refilled_at = time.monotonic()
+
+        self.latency = None
+        self.rate_adjusted_at = 0
+        self.last_listing_at = None
+        self.measured_rate = None
+
+        self.listings = 0
+        self.duration_throttled = 0
+
+        # The scheduler may run several crawls at once, they share the limit
+        self.lock = threading.Lock()
+
+        self.update_profile()
+
+    @staticmethod
+    def parse_profile(config, defaults=None):
+        """ Returns the tuple (listings_per_second, adaptive) of the given config """
+
+        if defaults is None:
+            defaults = (0, False)
+
+        listings_per_second = config.get('listings_per_second', defaults[0])
+        if not isinstance(listings_per_second, (int, float)) or listings_per_second < 0:
+            raise ValueError('Invalid "listings_per_second": %s, expected a number >= 0' % listings_per_second)
+
+        return listings_per_second, config.get('adaptive', defaults[1])
+
+    @staticmethod
+    def parse_time_of_day(value):
+        """ Parses "HH:MM" into the minute of the day """
+
+        re_match = re.match(r'^(\d{1,2}):(\d{2})$', str(value))
+        if not re_match or int(re_match.group(1)) > 24 or int(re_match.group(2)) > 59:
+            raise ValueError('Invalid time of day: %s, expected "HH:MM"' % value)
+
+        return int(re_match.group(1)) * 60 + int(re_match.group(2))
+
+    def update_profile(self):
+        """ Activates the profile matching the current time of day (checked at most once per minute) """
+
+        now = time.monotonic()
+        if self.active_profile is not None and now - self.profile_checked_at < 60:
+            return
+
+        self.profile_checked_at = now
+
+        local_time = time.localtime()
+        minute_of_day = local_time.tm_hour * 60 + local_time.tm_min
+
+        profile = self.default_profile
+        for start, end, candidate in self.profiles:
+            if start <= end:
+                matches = start <= minute_of_day < end
+            else:
+                # The profile spans midnight, e. g. 22:00 - 06:00
+                matches = minute_of_day >= start or minute_of_day < end
+
+            if matches:
+                profile = candidate
+                break
+
+        if profile != self.active_profile:
+            self.active_profile = profile
+            self.max_rate, self.adaptive = profile
+            self.rate = self.max_rate
+
+    def reset_stats(self):
+        """ Resets the statistics at the start of an indexing run """
+
+        self.listings = 0
+        self.duration_throttled = 0
+        self.last_listing_at = None
+
+    def wait(self):
+        """ Blocks until the next directory listing is allowed """
+
+        with self.lock:
+            self.update_profile()
+            self.listings += 1
+
+            now = time.monotonic()
+            if self.last_listing_at is not None and now > self.last_listing_at:
+                current_rate = 1 / (now - self.last_listing_at)
+                if self.measured_rate is None:
+                    self.measured_rate = current_rate
+                else:
+                    self.measured_rate = 0.9 * self.measured_rate + 0.1 * current_rate
+
+            if self.rate > 0:
+                self.tokens = min(self.burst, self.tokens + (now - self.tokens_refilled_at) * self.rate)
+                self.tokens_refilled_at = now
+
+                if self.tokens < 1:
+                    sleep_time = (1 - self.tokens) / self.rate
+                    time.sleep(sleep_time)
+                    self.duration_throttled += sleep_time
+                    self.tokens = 0
+                    self.tokens_refilled_at = time.monotonic()
+                else:
+                    self.tokens -= 1
+
+            self.last_listing_at = time.monotonic()
+
+    def observe(self, latency):
+        """ Feeds the duration of a directory listing into the adaptive mode """
+
+        if not self.adaptive:
+            return
+
+        with self.lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+
+            # Dont react to every single listing
+            now = time.monotonic()
+            if now - self.rate_adjusted_at < 1:
+                return
+            self.rate_adjusted_at = now
+
+            if self.latency > self.target_latency:
+                # The storage is busy: back off multiplicatively
+                current_rate = self.rate
+                if current_rate == 0 or (self.measured_rate is not None and self.measured_rate < current_rate):
+                    current_rate = self.measured_rate or self.min_listings_per_second
+
+                self.rate = max(self.min_listings_per_second, current_rate * 0.5)
+            elif self.rate > 0:
+                # The storage is fast enough: speed up again
+                if self.max_rate > 0:
+                    self.rate = min(self.max_rate, self.rate + max(1, self.max_rate * 0.05))
+                elif self.measured_rate is not None and self.rate > 2 * self.measured_rate:
+                    # We're not the limiting factor anymore
+                    self.rate = 0
+                else:
+                    self.rate = self.rate * 1.1 + 1
+
+    def effective_rate(self, duration):
+        """ Returns the average listings per second over the given duration """
+
+        if duration <= 0:
+            return 0
+
+        return self.listings / duration
@@ -0,0 +1,129 @@
+#-*- coding: utf-8 -*-
+
+import datetime
+import json
+import os
+import threading
+
+
+class DeadLetterFile(object):
+    """
+    Appends the bulk actions elasticsearch rejected to a NDJSON file (one action and its error per line)
+
+    The file is rotated like a log file: if it would grow beyond max_bytes, it's renamed to "<path>.1" (the older
+    files to "<path>.2" and so on) and only backup_count old files are kept. So the size is capped even if
+    elasticsearch rejects everything.
+    """
+
+    def __init__(self, path, max_bytes, backup_count):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+        self.file = None
+        self.lock = threading.Lock()
+
+    def write(self, action, status, error):
+        """ Appends the action and the error elasticsearch returned for it """
+
+        line = json.dumps(
+            {
+                "failed_at": datetime.datetime.now().isoformat(timespec='seconds'),
+                "status": status,
+                "error": error,
+                "action": action,
+            },
+            default=str
+        ) + '\n'
+
+        with self.lock:
+            if self.file is not None and self.moved():
+                # E. g. "replay_dead_letters" took the file
+                self.file.close()
+                self.file = None
+
+            if self.file is None:
+                self.file = open(self.path, 'a', errors='surrogateescape')
+
+            if self.file.tell() > 0 and self.file.tell() + len(line) > self.max_bytes:
+                self.rotate()
+
+            self.file.write(line)
+            self.file.flush()
+
+    def moved(self):
+        """ Tests if the open file isn't at path anymore """
+
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self.file.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def rotate(self):
+        """ Renames the current file to "<path>.1" (and so on) and starts a new one """
+
+        self.file.close()
+
+        for number in range(self.backup_count - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self.path, number)):
+                os.replace('%s.%d' % (self.path, number), '%s.%d' % (self.path, number + 1))
+
+        if self.backup_count > 0:
+            os.replace(self.path, '%s.1' % self.path)
+        else:
+            os.unlink(self.path)
+
+        self.file = open(self.path, 'a', errors='surrogateescape')
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def take(self):
+        """
+        Moves the current and the rotated files aside (oldest first) for a replay and returns their new paths
+
+        Files left over by an interrupted replay come first, they are older. Actions failing again during the replay
+        are written into a new file.
+        """
+
+        self.close()
+
+        paths = self.replay_paths()
+        number = int(paths[-1].rsplit('-', 1)[1]) + 1 if paths else 0
+        for backup_number in range(self.backup_count, -1, -1):
+            path = '%s.%d' % (self.path, backup_number) if backup_number > 0 else self.path
+            if os.path.exists(path):
+                replay_path = '%s.replay-%d' % (self.path, number)
+                os.replace(path, replay_path)
+                paths.append(replay_path)
+                number += 1
+
+        return paths
+
+    def replay_paths(self):
+        """ Returns the paths of the files moved aside by take() which weren't replayed yet, oldest first """
+
+        directory = os.path.dirname(self.path) or '.'
+        prefix = os.path.basename(self.path) + '.replay-'
+
+        numbers = []
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                numbers.append(int(name[len(prefix):]))
+
+        return ['%s.replay-%d' % (self.path, number) for number in sorted(numbers)]
+
+    @staticmethod
+    def read_actions(paths):
+        """ Yields the actions of the given files, skipping lines which can't be parsed """
+
+        for path in paths:
+            with open(path, 'r', errors='surrogateescape') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)['action']
+                    except (ValueError, KeyError, TypeError):
+                        continue
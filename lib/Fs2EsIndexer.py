@@ -1,15 +1,20 @@
 #-*- coding: utf-8 -*-
 
 import datetime
-import elasticsearch
-import elasticsearch.helpers
 import hashlib
 import itertools
 import json
 import os
 import re
+import threading
 import time
 
+from lib.CrawlScheduler import CrawlScheduler
+from lib.CrawlThrottle import CrawlThrottle
+from lib.DeadLetterFile import DeadLetterFile
+from lib.NodeLatencyStats import NodeLatencyStats
+from lib.SambaAuditLog import SambaAuditLog
+
 
 class Fs2EsIndexer(object):
     """ Indexes filenames and directory names into an ElasticSearch index ready for spotlight search via Samba 4 """
@@ -17,42 +22,80 @@ class Fs2EsIndexer(object):
     def __init__(self, config, verbose_messages):
         """ Constructor """
 
-        self.directories = config.get('directories', [])
-        self.dump_documents_on_error = config.get('dump_documents_on_error', False)
         self.verbose_messages = verbose_messages
 
         self.daemon_wait_time = config.get('wait_time', '30m')
-        re_match = re.match(r'^(\d+)(\w)$', self.daemon_wait_time)
-        if re_match:
-            suffix = re_match.group(2)
-            if suffix == 's':
-                self.daemon_wait_seconds = int(re_match.group(1))
-            elif suffix == 'm':
-                self.daemon_wait_seconds = int(re_match.group(1)) * 60
-            elif suffix == 'h':
-                self.daemon_wait_seconds = int(re_match.group(1)) * 60 * 60
-            elif suffix == 'd':
-                self.daemon_wait_seconds = int(re_match.group(1)) * 60 * 60 * 24
-            else:
-                Fs2EsIndexer.print('Unknown time unit in "wait_time": %s, expected "s", "m", "h" or "d"' % suffix)
-                exit(1)
-        else:
-            Fs2EsIndexer.print('Unknown "wait_time": %s' % self.daemon_wait_time)
+        try:
+            self.daemon_wait_seconds = CrawlScheduler.parse_wait_time(self.daemon_wait_time, 'wait_time')
+            self.crawl_scheduler = CrawlScheduler(
+                config.get('directories', []),
+                config.get('scheduler', {}),
+                self.daemon_wait_seconds
+            )
+        except ValueError as err:
+            Fs2EsIndexer.print(str(err))
             exit(1)
 
+        self.directories = self.crawl_scheduler.paths
+
         exclusions = config.get('exclusions', {})
         self.exclusion_strings = exclusions.get('partial_paths', [])
         self.exclusion_reg_exps = exclusions.get('regular_expressions', [])
 
+        try:
+            self.crawl_throttle = CrawlThrottle(config.get('throttle', {}))
+        except ValueError as err:
+            Fs2EsIndexer.print('Invalid "throttle" configuration: %s' % str(err))
+            exit(1)
+
         samba_config = config.get('samba', {})
         self.samba_audit_log = samba_config.get('audit_log', None)
         self.samba_monitor_sleep_time = samba_config.get('monitor_sleep_time', 1)
 
+        self.control_socket_path = config.get('control_socket', None)
+        self.control_socket = None
+        self.control_socket_polled_at = 0
+        self.phase = 'idle'
+        self.crawl_paused = False
+        self.crawl_cancelled = False
+        self.run_requested = False
+        self.paths_to_reindex = []
+        self.samba_audit_log_file = None
+        self.samba_audit_log_read_at = None
+
+        watcher_config = config.get('watcher', {})
+        self.watcher_enabled = watcher_config.get('enabled', False)
+        self.watcher_max_watches = watcher_config.get('max_watches', 100000)
+        self.watcher = None
+
+        # The watcher is read during the crawls too, its changes are collected until monitor_watcher() applies them
+        self.watcher_read_at = 0
+        self.watcher_paths_changed = {}
+        self.watcher_paths_to_rescan = set()
+        self.watcher_directories_to_crawl = {}
+
+        # The directories crawled right now
+        self.directories_crawling = set()
+
         elasticsearch_config = config.get('elasticsearch', {})
         self.elasticsearch_url = elasticsearch_config.get('url', 'http://localhost:9200')
         self.elasticsearch_index = elasticsearch_config.get('index', 'files')
         self.elasticsearch_bulk_size = elasticsearch_config.get('bulk_size', 10000)
         self.elasticsearch_index_mapping_file = elasticsearch_config.get('index_mapping', '/opt/fs2es-indexer/es-index-mapping.json')
+        self.elasticsearch_add_additional_fields = elasticsearch_config.get('add_additional_fields', False)
+        self.elasticsearch_bulk_retries = elasticsearch_config.get('bulk_retries', 3)
+        self.elasticsearch_bulk_retry_wait = elasticsearch_config.get('bulk_retry_wait', 2)
+
+        dead_letters_config = elasticsearch_config.get('dead_letters', {})
+        dead_letters_file = dead_letters_config.get('file', '/tmp/fs2es-indexer-dead-letters.ndjson')
+        if dead_letters_file:
+            self.elasticsearch_dead_letters = DeadLetterFile(
+                dead_letters_file,
+                dead_letters_config.get('max_size', 100) * 1024 * 1024,
+                dead_letters_config.get('backup_count', 3)
+            )
+        else:
+            self.elasticsearch_dead_letters = None
 
         self.elasticsearch_lib_version = elasticsearch_config.get('library_version', 8)
         if self.elasticsearch_lib_version != 7 and self.elasticsearch_lib_version != 8:
@@ -60,33 +103,103 @@ class Fs2EsIndexer(object):
                 'This tool only works with the elasticsearch library v7 or v8. Your configured version "%s" is not supported currently.' % self.elasticsearch_lib_version
             )
 
+        transport_config = elasticsearch_config.get('transport', {})
+        self.elasticsearch_bulk_workers = max(1, transport_config.get('bulk_workers', 1))
+        self.elasticsearch_node_stats = NodeLatencyStats()
+
+        # The URL can be a list of nodes
+        self.elasticsearch_hosts = self.elasticsearch_url
+        if isinstance(self.elasticsearch_hosts, list):
+            self.elasticsearch_url = ', '.join(self.elasticsearch_hosts)
+
+        self.elasticsearch_node_selector = transport_config.get('node_selector', 'round_robin')
+        if self.elasticsearch_node_selector not in ('round_robin', 'random'):
+            self.print('Unknown "node_selector": %s, expected "round_robin" or "random"' % self.elasticsearch_node_selector)
+            exit(1)
+
+        # The client (and the elasticsearch library, importing it takes longer than some actions) is only loaded by
+        # the actions using it, see the property "elasticsearch"
+        self.elasticsearch_config = elasticsearch_config
+        self.elasticsearch_transport_config = transport_config
+        self.elasticsearch_client = None
+
+        self.elasticsearch_document_ids = {}
+        self.elasticsearch_stats_lock = threading.Lock()
+        self.elasticsearch_reset_stats()
+        self.elasticsearch_tokenizer = 'fs2es-indexer-tokenizer'
+
+    @property
+    def elasticsearch(self):
+        """ The elasticsearch client, created on first use """
+
+        if self.elasticsearch_client is None:
+            self.elasticsearch_client = self.elasticsearch_create_client(
+                self.elasticsearch_config,
+                self.elasticsearch_transport_config
+            )
+
+        return self.elasticsearch_client
+
+    def elasticsearch_create_client(self, elasticsearch_config, transport_config):
+        """ Creates the elasticsearch client with the configured transport (compression, nodes, sniffing, pool size) """
+
+        import elasticsearch
+
         if 'user' in elasticsearch_config:
             elasticsearch_auth = (elasticsearch_config['user'], elasticsearch_config['password'])
         else:
             elasticsearch_auth = None
 
-        self.elasticsearch = elasticsearch.Elasticsearch(
-            hosts = self.elasticsearch_url,
+        client_options = {}
+        node_selector = self.elasticsearch_node_selector
+        sniff = transport_config.get('sniff', False)
+
+        if self.elasticsearch_lib_version == 7:
+            client_options['connection_class'] = self.elasticsearch_node_stats.node_class(
+                elasticsearch.connection.Urllib3HttpConnection
+            )
+            client_options['maxsize'] = self.elasticsearch_bulk_workers
+            client_options['selector_class'] = (
+                elasticsearch.connection_pool.RoundRobinSelector
+                if node_selector == 'round_robin'
+                else elasticsearch.connection_pool.RandomSelector
+            )
+            if sniff:
+                client_options['sniff_on_start'] = True
+                client_options['sniff_on_connection_fail'] = True
+                client_options['sniffer_timeout'] = transport_config.get('sniff_interval', 300)
+        else:
+            # The transport was split into its own library in v8
+            import elastic_transport
+
+            client_options['node_class'] = self.elasticsearch_node_stats.node_class(elastic_transport.Urllib3HttpNode)
+            client_options['connections_per_node'] = self.elasticsearch_bulk_workers
+            client_options['node_selector_class'] = node_selector
+            if sniff:
+                client_options['sniff_on_start'] = True
+                client_options['sniff_on_node_failure'] = True
+                client_options['min_delay_between_sniffing'] = transport_config.get('sniff_interval', 300)
+
+        return elasticsearch.Elasticsearch(
+            hosts = self.elasticsearch_hosts,
             http_auth = elasticsearch_auth,
-            max_retries = 10,
+            http_compress = transport_config.get('compress', False),
+            max_retries = transport_config.get('max_retries', 10),
             retry_on_timeout = True,
             verify_certs = elasticsearch_config.get('verify_certs', True),
             ssl_show_warn = elasticsearch_config.get('ssl_show_warn', True),
-            ca_certs = elasticsearch_config.get('ca_certs', None)
+            ca_certs = elasticsearch_config.get('ca_certs', None),
+            **client_options
         )
 
-        self.elasticsearch_document_ids = {}
-        self.duration_elasticsearch = 0
-        self.elasticsearch_tokenizer = 'fs2es-indexer-tokenizer'
-
     @staticmethod
     def format_count(count):
         return '{:,}'.format(count).replace(',', ' ')
 
-    def elasticsearch_map_path_to_document(self, path, filename):
-        """ Maps a file or directory path to an elasticsearch document """
+    def elasticsearch_map_path_to_document(self, path, filename, stat=None):
+        """ Maps a file or directory path (and its stat result if the additional fields are enabled) to an elasticsearch document """
 
-        return {
+        document = {
             "_op_type": "index",
             "_id": self.elasticsearch_map_path_to_id(path),
             "_source": {
@@ -99,36 +212,636 @@ class Fs2EsIndexer(object):
             }
         }
 
+        if stat is not None:
+            document['_source']['file'].update(self.elasticsearch_map_stat_to_fields(stat))
+
+        return document
+
+    def elasticsearch_map_stat_to_update(self, document_id, stat):
+        """ Maps the stat result of a changed file or directory to a partial update of its elasticsearch document """
+
+        return {
+            "_op_type": "update",
+            "_id": document_id,
+            "doc": {
+                "file": self.elasticsearch_map_stat_to_fields(stat)
+            }
+        }
+
+    @staticmethod
+    def elasticsearch_map_stat_to_fields(stat):
+        """ Maps a stat result to the additional fields of the "file" object, see the samba elasticsearch_mappings.json """
+
+        return {
+            "filesize": stat.st_size,
+            "last_modified": time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(int(stat.st_mtime)))
+        }
+
+    @staticmethod
+    def stat_fingerprint(stat):
+        """ Compact fingerprint of the additional fields, kept next to the document IDs to detect changes """
+
+        return hash((int(stat.st_mtime), stat.st_size))
+
+    @staticmethod
+    def source_fingerprint(source):
+        """ The fingerprint (see stat_fingerprint) of an elasticsearch document, 1 if it has no additional fields """
+
+        try:
+            last_modified = datetime.datetime.fromisoformat(source['file']['last_modified'])
+            mtime = int(last_modified.replace(tzinfo=datetime.timezone.utc).timestamp())
+            return hash((mtime, source['file']['filesize']))
+        except (KeyError, TypeError, ValueError):
+            return 1
+
+    @staticmethod
+    def stat_entry(entry):
+        """ Returns the stat result of the os.DirEntry (of the link itself for broken symlinks) or None if its gone """
+
+        try:
+            return entry.stat()
+        except OSError:
+            try:
+                return entry.stat(follow_symlinks=False)
+            except OSError:
+                return None
+
+    def stat_path(self, path):
+        """ Returns the stat result of the path if the additional fields are enabled, False if its gone """
+
+        if not self.elasticsearch_add_additional_fields:
+            return None
+
+        try:
+            return os.stat(path)
+        except OSError:
+            try:
+                return os.lstat(path)
+            except OSError:
+                return False
+
     @staticmethod
     def elasticsearch_map_path_to_id(path):
         """ Maps the path to a unique elasticsearch document ID """
         return hashlib.sha256(path.encode('utf-8', 'surrogatepass')).hexdigest()
 
     def elasticsearch_bulk_action(self, documents):
-        """ Imports documents into elasticsearch or deletes documents from there """
+        """
+        Imports documents into elasticsearch or deletes documents from there
 
-        # See https://elasticsearch-py.readthedocs.io/en/v8.6.2/helpers.html#bulk-helpers
+        The result of each document is checked on its own: temporary failures (e. g. elasticsearch is overloaded) are
+        retried, everything else is written to the dead letter file. So a single bad document doesn't stop the run.
+        """
 
         start_time = time.time()
+        documents_written, documents_failed = self.elasticsearch_bulk_send(documents, self.elasticsearch_bulk_retries)
+
+        # The crawls of the scheduler may run in threads
+        with self.elasticsearch_stats_lock:
+            self.elasticsearch_documents_written += documents_written
+            self.elasticsearch_documents_failed += documents_failed
+            self.duration_elasticsearch += time.time() - start_time
+
+    def elasticsearch_bulk_send(self, documents, retries):
+        """ Sends the documents in bulk requests and returns the amount of written and failed documents """
+
+        import elasticsearch.helpers
+
+        # See https://elasticsearch-py.readthedocs.io/en/v8.6.2/helpers.html#bulk-helpers
+
+        documents_written = 0
+        documents_failed = 0
+        documents_to_retry = []
+
+        # The results only contain the operation and the ID: keep the documents of the running requests to retry
+        # or dead letter them (the bulk helpers consume the documents chunk by chunk, so this stays small)
+        documents_sent = {}
+
+        def documents_to_send():
+            for document in documents:
+                documents_sent.setdefault((document.get('_op_type', 'index'), document['_id']), []).append(document)
+                yield document
+
+        if self.elasticsearch_bulk_workers > 1:
+            results = elasticsearch.helpers.parallel_bulk(
+                self.elasticsearch,
+                documents_to_send(),
+                index=self.elasticsearch_index,
+                thread_count=self.elasticsearch_bulk_workers,
+                raise_on_error=False,
+                raise_on_exception=False
+            )
+        else:
+            results = elasticsearch.helpers.streaming_bulk(
+                self.elasticsearch,
+                documents_to_send(),
+                index=self.elasticsearch_index,
+                raise_on_error=False,
+                raise_on_exception=False
+            )
+
         try:
-            elasticsearch.helpers.bulk(self.elasticsearch, documents, index=self.elasticsearch_index)
+            for ok, result in results:
+                operation, result = result.popitem()
+                status = result.get('status')
+                document = documents_sent[(operation, result.get('_id'))].pop(0)
+                if len(documents_sent[(operation, result.get('_id'))]) == 0:
+                    del documents_sent[(operation, result.get('_id'))]
+
+                # Deleting an already deleted document is fine
+                if ok or (status == 404 and operation == 'delete'):
+                    documents_written += 1
+                    continue
+
+                if status == 404 and operation == 'update':
+                    # The document is missing in the index: the next crawl imports the whole document again
+                    self.elasticsearch_document_ids.pop(document['_id'], None)
+                    self.print_verbose('*- document "%s" to update is missing, will be imported again', document['_id'])
+                    continue
+
+                if retries > 0 and (not isinstance(status, int) or status == 429 or status >= 500):
+                    # Temporary: elasticsearch is overloaded, a node is restarting, ...
+                    documents_to_retry.append(document)
+
+                    # Stay within the memory of one bulk request, e. g. if elasticsearch is down for a while
+                    if len(documents_to_retry) >= self.elasticsearch_bulk_size:
+                        documents_retried = self.elasticsearch_bulk_retry(documents_to_retry, retries)
+                        documents_written += documents_retried[0]
+                        documents_failed += documents_retried[1]
+                        documents_to_retry = []
+                    continue
+
+                self.elasticsearch_dead_letter(document, status, result.get('error'))
+                documents_failed += 1
         except Exception as err:
-            self.print(
+            # Not the fault of single documents, e. g. elasticsearch isn't reachable at all
+            self.print_error(
                 'Failed to bulk import/delete documents into elasticsearch "%s": %s' % (self.elasticsearch_url, str(err))
             )
+            exit(1)
 
-            if self.dump_documents_on_error:
-                filename = '/tmp/fs2es-indexer-failed-documents-%s.json' % datetime.datetime.now().strftime("%Y-%m-%d_%H_%M_%S")
-                with open(filename, 'w') as f:
-                    json.dump(documents, f)
+        if len(documents_to_retry) > 0:
+            documents_retried = self.elasticsearch_bulk_retry(documents_to_retry, retries)
+            documents_written += documents_retried[0]
+            documents_failed += documents_retried[1]
 
-                self.print_error(
-                    'Dumped the failed documents to %s, please review it and report bugs upstream.' % filename
-                )
+        return documents_written, documents_failed
 
+    def elasticsearch_bulk_retry(self, documents, retries):
+        """ Sends the documents again after a (with each retry growing) wait time """
+
+        wait_time = self.elasticsearch_bulk_retry_wait * 2 ** (self.elasticsearch_bulk_retries - retries)
+        self.print(
+            'Elasticsearch failed to process %s document(s) temporarily, retrying in %d sec(s) ...' % (
+                self.format_count(len(documents)),
+                wait_time
+            )
+        )
+        time.sleep(wait_time)
+
+        return self.elasticsearch_bulk_send(documents, retries - 1)
+
+    def elasticsearch_dead_letter(self, document, status, error):
+        """ Writes a document elasticsearch rejected to the dead letter file and fixes the document IDs in RAM """
+
+        if document.get('_op_type', 'index') == 'delete':
+            # Still in the index: the next indexing run wont find the path and deletes the document again
+            self.elasticsearch_document_ids.setdefault(document['_id'], 1)
+        else:
+            # Not (or not completely) in the index: the next indexing run imports the path again
+            self.elasticsearch_document_ids.pop(document['_id'], None)
+
+        self.print_verbose('*- elasticsearch rejected document "%s": %s', document['_id'], error)
+
+        if self.elasticsearch_dead_letters is None:
+            return
+
+        try:
+            self.elasticsearch_dead_letters.write(document, status, error)
+        except OSError as err:
+            self.print_error(
+                'Failed to write to the dead letter file "%s": %s' % (self.elasticsearch_dead_letters.path, str(err))
+            )
+
+    def elasticsearch_replay_dead_letters(self):
+        """ Sends the documents of the dead letter files to elasticsearch again """
+
+        if self.elasticsearch_dead_letters is None:
+            self.print_error('No "elasticsearch.dead_letters.file" configured.')
             exit(1)
 
-        self.duration_elasticsearch += time.time() - start_time
+        paths = self.elasticsearch_dead_letters.take()
+        if len(paths) == 0:
+            self.print('No dead letters in "%s".' % self.elasticsearch_dead_letters.path)
+            return
+
+        self.print('Replaying the dead letters of "%s" ...' % self.elasticsearch_dead_letters.path)
+
+        self.elasticsearch_bulk_action(self.elasticsearch_dead_letters.read_actions(paths))
+
+        for path in paths:
+            os.unlink(path)
+
+        self.print(
+            'Replayed the dead letters: %s document(s) written, %s failed again.' % (
+                self.format_count(self.elasticsearch_documents_written),
+                self.format_count(self.elasticsearch_documents_failed)
+            )
+        )
+
+        if self.elasticsearch_documents_failed > 0:
+            self.print('The failed documents were written to "%s" again.' % self.elasticsearch_dead_letters.path)
+
+    def elasticsearch_reset_stats(self):
+        """ Resets the statistics of the elasticsearch requests at the start of an indexing run """
+
+        self.duration_elasticsearch = 0
+        self.elasticsearch_documents_written = 0
+        self.elasticsearch_documents_failed = 0
+        self.elasticsearch_node_stats.reset()
+
+    def elasticsearch_print_stats(self):
+        """ Prints the statistics of the elasticsearch requests at the end of an indexing run """
+
+        self.print('Elasticsearch import lasted %.2f minutes.' % (self.duration_elasticsearch / 60))
+
+        if self.elasticsearch_documents_failed > 0:
+            self.print_error(
+                'Elasticsearch rejected %s document(s)%s, %s document(s) were written.' % (
+                    self.format_count(self.elasticsearch_documents_failed),
+                    ' (see "%s")' % self.elasticsearch_dead_letters.path if self.elasticsearch_dead_letters else '',
+                    self.format_count(self.elasticsearch_documents_written)
+                )
+            )
+
+        for node_summary in self.elasticsearch_node_stats.summary():
+            self.print('- Elasticsearch node %s' % node_summary)
+
+    def elasticsearch_live_update(self, paths_to_import, paths_to_delete):
+        """ Imports and deletes the given paths in bulk requests, e. g. for the changes between indexing runs """
+
+        documents = []
+
+        for path in paths_to_delete:
+            self.print_verbose('*- delete "%s"', path)
+
+            document_id = self.elasticsearch_map_path_to_id(path)
+            self.elasticsearch_document_ids.pop(document_id, None)
+            documents.append({
+                "_op_type": "delete",
+                "_id": document_id
+            })
+
+            if len(documents) >= self.elasticsearch_bulk_size:
+                self.elasticsearch_bulk_action(documents)
+                documents = []
+
+        for path in paths_to_import:
+            stat = self.stat_path(path)
+            if stat is False:
+                # File/Dir does not exist anymore? Don't index it!
+                continue
+
+            self.print_verbose('*- import "%s"', path)
+
+            document = self.elasticsearch_map_path_to_document(
+                path=path,
+                filename=os.path.basename(path),
+                stat=stat
+            )
+            self.elasticsearch_document_ids[document['_id']] = 1 if stat is None else self.stat_fingerprint(stat)
+            documents.append(document)
+
+            if len(documents) >= self.elasticsearch_bulk_size:
+                self.elasticsearch_bulk_action(documents)
+                documents = []
+
+        if len(documents) > 0:
+            self.elasticsearch_bulk_action(documents)
+
+    @staticmethod
+    def elasticsearch_subtree_query(*paths, below_only=False):
+        """ Returns the query for the documents of the paths (unless below_only) and all documents below them """
+
+        should = []
+        for path in paths:
+            if not below_only:
+                should.append({"term": {"path.real": path}})
+            should.append({"prefix": {"path.real": path.rstrip(os.sep) + os.sep}})
+
+        return {
+            "bool": {
+                "should": should
+            }
+        }
+
+    def elasticsearch_get_ids_by_path(self, path):
+        """ Reads the IDs, paths and fingerprints of the document of path and all documents below it from elasticsearch """
+
+        import elasticsearch.helpers
+
+        documents = {}
+        for hit in elasticsearch.helpers.scan(
+            self.elasticsearch,
+            query={
+                "query": self.elasticsearch_subtree_query(path),
+                "_source": ["path.real", "file.filesize", "file.last_modified"]
+            },
+            index=self.elasticsearch_index,
+            size=self.elasticsearch_bulk_size
+        ):
+            if self.elasticsearch_add_additional_fields:
+                documents[hit['_id']] = (hit['_source']['path']['real'], self.source_fingerprint(hit['_source']))
+            else:
+                documents[hit['_id']] = (hit['_source']['path']['real'], 1)
+
+        return documents
+
+    def elasticsearch_get_paths_by_ids(self, document_ids):
+        """ Yields the ID and the path of the documents with the given IDs, read in chunks of bulk_size """
+
+        import elasticsearch.helpers
+
+        for start_index in range(0, len(document_ids), self.elasticsearch_bulk_size):
+            for hit in elasticsearch.helpers.scan(
+                self.elasticsearch,
+                query={
+                    "query": {
+                        "ids": {
+                            "values": document_ids[start_index:start_index + self.elasticsearch_bulk_size]
+                        }
+                    },
+                    "_source": ["path.real"]
+                },
+                index=self.elasticsearch_index,
+                size=self.elasticsearch_bulk_size
+            ):
+                yield hit['_id'], hit['_source'].get('path', {}).get('real', None)
+
+    def elasticsearch_delete_subtree(self, path):
+        """ Deletes the document of path and all documents below it, e. g. when a whole directory got deleted """
+
+        return self.elasticsearch_delete_subtrees([path])
+
+    def elasticsearch_delete_subtrees(self, paths, document_ids_to_keep=None, below_only=False):
+        """
+        Deletes the documents of the paths (unless below_only) and all documents below them (except the ones in
+        document_ids_to_keep)
+
+        The IDs are streamed from prefix queries on "path.real" directly into bulk deletes, so neither the paths nor
+        the IDs of the subtrees have to fit into RAM at once. Keep in mind that searches only see the documents of the
+        last refresh of the index.
+        """
+
+        import elasticsearch.helpers
+
+        start_time = time.time()
+        documents_deleted = 0
+
+        def documents():
+            nonlocal documents_deleted
+
+            # Each path needs 2 clauses, stay well below the default limit of 1024 clauses per query
+            for start_index in range(0, len(paths), 250):
+                for hit in elasticsearch.helpers.scan(
+                    self.elasticsearch,
+                    query={
+                        "query": self.elasticsearch_subtree_query(
+                            *paths[start_index:start_index + 250],
+                            below_only=below_only
+                        ),
+                        "_source": False
+                    },
+                    index=self.elasticsearch_index,
+                    size=self.elasticsearch_bulk_size
+                ):
+                    if document_ids_to_keep is not None and hit['_id'] in document_ids_to_keep:
+                        continue
+
+                    self.elasticsearch_document_ids.pop(hit['_id'], None)
+                    documents_deleted += 1
+
+                    yield {
+                        "_op_type": "delete",
+                        "_id": hit['_id']
+                    }
+
+        self.elasticsearch_bulk_action(documents())
+
+        self.print_verbose(
+            '*- deleted %s document(s) of %d path(s) in %.2f sec(s)',
+            self.format_count(documents_deleted),
+            len(paths),
+            time.time() - start_time
+        )
+
+        return documents_deleted
+
+    def elasticsearch_move_subtree(self, source_path, target_path):
+        """
+        Moves the document of source_path and all documents below it to target_path via streamed bulk requests and
+        returns the amount of moved documents
+        """
+
+        import elasticsearch.helpers
+
+        start_time = time.time()
+        documents_moved = 0
+
+        def documents():
+            nonlocal documents_moved
+
+            for hit in elasticsearch.helpers.scan(
+                self.elasticsearch,
+                query={
+                    "query": self.elasticsearch_subtree_query(source_path),
+                    "_source": ["path.real", "file.filesize", "file.last_modified"]
+                },
+                index=self.elasticsearch_index,
+                size=self.elasticsearch_bulk_size
+            ):
+                # Each of these documents got moved from source_path to target_path!
+                hit_old_path = hit['_source']['path']['real']
+                self.print_verbose('*- delete "%s"', hit_old_path)
+                self.elasticsearch_document_ids.pop(hit['_id'], None)
+
+                yield {
+                    "_op_type": "delete",
+                    "_id": hit['_id']
+                }
+
+                hit_new_path = target_path + hit_old_path[len(source_path):]
+                self.print_verbose('*- import "%s"', hit_new_path)
+                document = self.elasticsearch_map_path_to_document(
+                    path=hit_new_path,
+                    filename=os.path.basename(hit_new_path)
+                )
+
+                fingerprint = 1
+                if self.elasticsearch_add_additional_fields:
+                    # Moving doesnt change the metadata
+                    for field in ('filesize', 'last_modified'):
+                        if field in hit['_source'].get('file', {}):
+                            document['_source']['file'][field] = hit['_source']['file'][field]
+
+                    fingerprint = self.source_fingerprint(hit['_source'])
+
+                self.elasticsearch_document_ids[document['_id']] = fingerprint
+                documents_moved += 1
+
+                yield document
+
+        self.elasticsearch_bulk_action(documents())
+
+        self.print_verbose(
+            '*- moved %s document(s) from "%s" to "%s" in %.2f sec(s)',
+            self.format_count(documents_moved),
+            source_path,
+            target_path,
+            time.time() - start_time
+        )
+
+        return documents_moved
+
+    def reindex_path(self, path):
+        """ Compares the subtree of path (including path itself) with the index and imports / deletes the differences """
+
+        start_time = time.time()
+        phase = self.phase
+        self.phase = 'reindexing'
+        self.print_verbose('* Rescanning "%s"' % path)
+
+        if not os.path.lexists(path):
+            # Nothing left to crawl: delete the whole subtree from the index
+            documents_deleted = self.elasticsearch_delete_subtree(path)
+
+            self.print(
+                'Rescanned "%s" in %.2f sec(s): path is gone, %s path(s) deleted.' % (
+                    path,
+                    time.time() - start_time,
+                    self.format_count(documents_deleted)
+                )
+            )
+
+            self.phase = phase
+            return
+
+        documents_old = self.elasticsearch_get_ids_by_path(path)
+        paths_to_import = []
+        paths_imported = 0
+
+        for crawled_path in self.walk_path(path):
+            if not self.path_should_be_indexed(crawled_path, True):
+                continue
+
+            document_id = self.elasticsearch_map_path_to_id(crawled_path)
+            document_old = documents_old.pop(document_id, None)
+
+            fingerprint = 1
+            if self.elasticsearch_add_additional_fields:
+                stat = self.stat_path(crawled_path)
+                fingerprint = self.stat_fingerprint(stat) if stat else None
+
+            if document_old is None or (self.elasticsearch_add_additional_fields and document_old[1] != fingerprint):
+                # New or changed: (re)import it completely
+                paths_to_import.append(crawled_path)
+
+                if len(paths_to_import) >= self.elasticsearch_bulk_size:
+                    self.elasticsearch_live_update(paths_to_import, [])
+                    paths_imported += len(paths_to_import)
+                    paths_to_import = []
+            else:
+                self.elasticsearch_document_ids[document_id] = fingerprint
+
+        self.elasticsearch_live_update(paths_to_import, [])
+        paths_imported += len(paths_to_import)
+
+        # Everything that wasnt found anymore has to be deleted
+        paths_to_delete = [document_old[0] for document_old in documents_old.values()]
+        self.elasticsearch_live_update([], paths_to_delete)
+
+        self.print(
+            'Rescanned "%s" in %.2f sec(s): %s path(s) imported, %s path(s) deleted.' % (
+                path,
+                time.time() - start_time,
+                self.format_count(paths_imported),
+                self.format_count(len(paths_to_delete))
+            )
+        )
+
+        self.phase = phase
+
+    def walk_path(self, path):
+        """ Yields path itself (if it exists and isn't one of the directories) and all files and directories below it """
+
+        if not os.path.lexists(path):
+            return
+
+        # The indexing runs dont index the directories themselves
+        if path not in self.directories:
+            yield path
+
+        if os.path.isdir(path) and not os.path.islink(path):
+            for root, dirs, files in self.walk_directory(path):
+                for entry in itertools.chain(files, dirs):
+                    yield entry.path
+
+    def walk_directory(self, directory):
+        """ Walks the directory top-down like os.walk(), but throttled and yielding os.DirEntry objects instead of names """
+
+        # The crawls of the scheduler may run in threads, only the main thread serves the control socket
+        in_main_thread = threading.current_thread() is threading.main_thread()
+
+        stack = [directory]
+        while stack and not self.crawl_cancelled:
+            root = stack.pop()
+
+            if in_main_thread and self.control_socket is not None and time.monotonic() - self.control_socket_polled_at > 1:
+                self.control_socket_poll()
+
+            if in_main_thread and self.watcher is not None and time.monotonic() - self.watcher_read_at > 1:
+                # Keep the event queue of the kernel from overflowing during a long crawl
+                self.watcher_read_changes(0)
+
+            while self.crawl_paused and not self.crawl_cancelled:
+                if in_main_thread:
+                    self.control_socket_poll(1)
+                else:
+                    time.sleep(1)
+
+            self.crawl_throttle.wait()
+            listing_start_time = time.monotonic()
+
+            if self.watcher is not None:
+                # Before the listing: changes after it are reported by the watch
+                self.watcher.watch_missing(root)
+
+            dirs = []
+            files = []
+            subdirectories = []
+            try:
+                with os.scandir(root) as it:
+                    for entry in it:
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            is_dir = False
+
+                        if is_dir:
+                            dirs.append(entry)
+                            if not entry.is_symlink():
+                                subdirectories.append(entry.path)
+                        else:
+                            files.append(entry)
+            except OSError:
+                # Like os.walk(): ignore directories that vanished or can't be read
+                continue
+
+            self.crawl_throttle.observe(time.monotonic() - listing_start_time)
+
+            yield root, dirs, files
+
+            stack.extend(reversed(subdirectories))
 
     def elasticsearch_analyze_index(self):
         """
@@ -190,6 +903,8 @@ class Fs2EsIndexer(object):
         for the fields expected by samba and their mappings to the expected Spotlight results
         """
 
+        import elasticsearch
+
         with open(self.elasticsearch_index_mapping_file, 'r') as f:
             index_mapping = json.load(f)
 
@@ -245,6 +960,8 @@ class Fs2EsIndexer(object):
             print(' done.')
 
     def elasticsearch_create_index(self, index_mapping):
+        import elasticsearch
+
         index_settings = {
             "analysis": {
                 "tokenizer": {
@@ -289,6 +1006,8 @@ class Fs2EsIndexer(object):
     def elasticsearch_refresh_index(self):
         """ Refresh the elasticsearch index """
 
+        import elasticsearch
+
         self.print('Refreshing index "%s" ...' % self.elasticsearch_index, end='')
         start_time = time.time()
         try:
@@ -321,59 +1040,78 @@ class Fs2EsIndexer(object):
         documents = []
         documents_to_be_indexed = 0
         documents_indexed = 0
-        self.duration_elasticsearch = 0
+        documents_updated = 0
+        self.elasticsearch_reset_stats()
+        self.crawl_throttle.reset_stats()
         start_time = round(time.time())
 
+        self.phase = 'crawling'
         self.print('Starting to index the files and directories ...')
 
         for directory in self.directories:
             self.print('- Starting to index directory "%s" ...' % directory)
+            self.directories_crawling = {directory}
 
-            for root, dirs, files in os.walk(directory):
-                for name in itertools.chain(files, dirs):
-                    full_path = os.path.join(root, name)
+            for root, dirs, files in self.walk_directory(directory):
+                for entry in itertools.chain(files, dirs):
+                    full_path = entry.path
                     if self.path_should_be_indexed(full_path, False):
-                        try:
-                            document = self.elasticsearch_map_path_to_document(
-                                path=full_path,
-                                filename=name
+                        stat = None
+                        fingerprint = 1
+                        if self.elasticsearch_add_additional_fields:
+                            stat = self.stat_entry(entry)
+                            if stat is None:
+                                # File/Dir does not exist anymore? Don't index it!
+                                continue
+
+                            fingerprint = self.stat_fingerprint(stat)
+
+                        paths_total += 1
+
+                        document_id = self.elasticsearch_map_path_to_id(full_path)
+                        fingerprint_old = elasticsearch_document_ids_old.pop(document_id, None)
+
+                        if fingerprint_old is None:
+                            # Only add _new_ files and dirs to the index
+                            documents.append(
+                                self.elasticsearch_map_path_to_document(
+                                    path=full_path,
+                                    filename=entry.name,
+                                    stat=stat
+                                )
+                            )
+                        elif self.elasticsearch_add_additional_fields and fingerprint_old != fingerprint:
+                            # ... and update the metadata of changed ones
+                            documents.append(self.elasticsearch_map_stat_to_update(document_id, stat))
+                            documents_updated += 1
+
+                        # Before the bulk request: a rejected document removes its ID again
+                        self.elasticsearch_document_ids[document_id] = fingerprint
+
+                        if len(documents) >= self.elasticsearch_bulk_size:
+                            documents_to_be_indexed = len(documents)
+                            self.elasticsearch_bulk_action(documents)
+
+                            documents = []
+                            documents_indexed += documents_to_be_indexed
+                            documents_to_be_indexed = 0
+                            self.print(
+                                '- %s paths indexed, elasticsearch import lasted %.2f / %.2f min(s)' % (
+                                    self.format_count(documents_indexed),
+                                    self.duration_elasticsearch / 60,
+                                    (time.time() - start_time) / 60
+                                )
                             )
-                        except FileNotFoundError:
-                            # File/Dir does not exist anymore? Don't index it!
-                            document = None
-
-                        if document is not None :
-                            paths_total += 1
-
-                            if document['_id'] not in elasticsearch_document_ids_old:
-                                # Only add _new_ files and dirs to the index
-                                documents.append(document)
-                                documents_to_be_indexed += 1
-
-                                if documents_to_be_indexed >= self.elasticsearch_bulk_size:
-                                    self.elasticsearch_bulk_action(documents)
-
-                                    documents = []
-                                    documents_indexed += documents_to_be_indexed
-                                    documents_to_be_indexed = 0
-                                    self.print(
-                                        '- %s paths indexed, elasticsearch import lasted %.2f / %.2f min(s)' % (
-                                            self.format_count(documents_indexed),
-                                            self.duration_elasticsearch / 60,
-                                            (time.time() - start_time) / 60
-                                        )
-                                    )
-
-                            try:
-                                del elasticsearch_document_ids_old[document['_id']]
-                            except:
-                                pass
-
-                            self.elasticsearch_document_ids[document['_id']] = 1
+
+            if self.watcher is not None:
+                self.watcher.rewatched(directory)
 
             self.print('- Indexing of directory "%s" done.' % directory)
 
+        self.directories_crawling = set()
+
         # Add the remaining documents...
+        documents_to_be_indexed = len(documents)
         if documents_to_be_indexed > 0:
             self.print('- Importing remaining documents')
 
@@ -443,10 +1181,310 @@ class Fs2EsIndexer(object):
                 end_index += self.elasticsearch_bulk_size
 
         self.print('Total paths crawled: %s' % self.format_count(paths_total))
-        self.print('New paths indexed: %s' % self.format_count(documents_indexed))
+        self.print('New paths indexed: %s' % self.format_count(documents_indexed - documents_updated))
+        if self.elasticsearch_add_additional_fields:
+            self.print('Changed paths updated: %s' % self.format_count(documents_updated))
         self.print('Old paths deleted: %s' % self.format_count(old_document_count))
+        self.print(
+            'Directory listings: %s (%.1f/s effective), throttled for %.2f minutes.' % (
+                self.format_count(self.crawl_throttle.listings),
+                self.crawl_throttle.effective_rate(time.time() - start_time),
+                self.crawl_throttle.duration_throttled / 60
+            )
+        )
         self.print('Indexing run done after %.2f minutes.' % ((time.time() - start_time) / 60))
-        self.print('Elasticsearch import lasted %.2f minutes.' % (self.duration_elasticsearch / 60))
+
+        self.phase = 'idle'
+        self.elasticsearch_print_stats()
+
+    def crawl_directory(self, directory):
+        """
+        Imports the content of one of the directories into the elasticsearch index, e. g. for the crawls of the scheduler
+
+        Unlike index_directories() the old documents can't be told apart by their IDs alone: afterwards the IDs below
+        the directory are streamed from elasticsearch and the ones the crawler didn't find are deleted.
+        """
+
+        start_time = time.time()
+        self.print('- Starting to crawl directory "%s" ...' % directory)
+
+        document_ids_found = set()
+        documents = []
+        paths_total = 0
+        documents_indexed = 0
+        documents_updated = 0
+
+        for root, dirs, files in self.walk_directory(directory):
+            for entry in itertools.chain(files, dirs):
+                full_path = entry.path
+                if not self.path_should_be_indexed(full_path, False):
+                    continue
+
+                stat = None
+                fingerprint = 1
+                if self.elasticsearch_add_additional_fields:
+                    stat = self.stat_entry(entry)
+                    if stat is None:
+                        # File/Dir does not exist anymore? Don't index it!
+                        continue
+
+                    fingerprint = self.stat_fingerprint(stat)
+
+                paths_total += 1
+
+                document_id = self.elasticsearch_map_path_to_id(full_path)
+
+                # Reinserted below: document_ids_found shares the key strings of the dict instead of holding copies
+                fingerprint_old = self.elasticsearch_document_ids.pop(document_id, None)
+                document_ids_found.add(document_id)
+
+                if fingerprint_old is None:
+                    documents.append(
+                        self.elasticsearch_map_path_to_document(
+                            path=full_path,
+                            filename=entry.name,
+                            stat=stat
+                        )
+                    )
+                    documents_indexed += 1
+                elif self.elasticsearch_add_additional_fields and fingerprint_old != fingerprint:
+                    documents.append(self.elasticsearch_map_stat_to_update(document_id, stat))
+                    documents_updated += 1
+
+                self.elasticsearch_document_ids[document_id] = fingerprint
+
+                if len(documents) >= self.elasticsearch_bulk_size:
+                    self.elasticsearch_bulk_action(documents)
+                    documents = []
+
+        if len(documents) > 0:
+            self.elasticsearch_bulk_action(documents)
+
+        if self.crawl_cancelled:
+            # An incomplete crawl can't tell which documents are old
+            return paths_total
+
+        if self.watcher is not None:
+            self.watcher.rewatched(directory)
+
+        documents_deleted = self.elasticsearch_delete_subtrees([directory], document_ids_found)
+
+        self.print(
+            '- Crawled directory "%s" in %.2f min(s): %s path(s) crawled, %s new, %s changed, %s deleted.' % (
+                directory,
+                (time.time() - start_time) / 60,
+                self.format_count(paths_total),
+                self.format_count(documents_indexed),
+                self.format_count(documents_updated),
+                self.format_count(documents_deleted)
+            )
+        )
+
+        return paths_total
+
+    def crawl_due_directories(self):
+        """
+        Crawls the due directories of the scheduler, the highest priority first and up to max_concurrent_crawls at once
+
+        Directories that get due again while other crawls are still running are crawled again, so a small and busy
+        directory stays fresh during a long crawl of a big one.
+        """
+
+        directories_due = self.crawl_scheduler.due_directories()
+        if len(directories_due) == 0:
+            return
+
+        if self.crawl_scheduler.max_concurrent_crawls == 1 and len(directories_due) == len(self.directories):
+            # Everything is due (e. g. all directories share the global wait_time): a complete indexing run needs no
+            # extra requests to find the old documents
+            self.index_directories()
+            self.crawl_scheduler.crawled_all()
+            self.watcher_replay_changes(self.directories)
+            return
+
+        self.elasticsearch_reset_stats()
+        self.crawl_throttle.reset_stats()
+        self.crawl_cancelled = False
+        start_time = time.time()
+
+        self.phase = 'crawling'
+        self.print('Starting to crawl the due directories %s ...' % ', '.join('"%s"' % path for path in directories_due))
+
+        paths_total = 0
+        directories_crawled = []
+        crawls_running = {}
+
+        import concurrent.futures
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.crawl_scheduler.max_concurrent_crawls)
+        try:
+            while True:
+                # Every directory is crawled once, more often only while the other crawls are running anyway
+                directories_excluded = set(crawls_running.values())
+                if len(crawls_running) == 0:
+                    directories_excluded.update(directories_crawled)
+
+                for directory in self.crawl_scheduler.due_directories(directories_excluded):
+                    if len(crawls_running) >= self.crawl_scheduler.max_concurrent_crawls:
+                        break
+
+                    crawls_running[executor.submit(self.crawl_directory, directory)] = directory
+
+                if len(crawls_running) == 0:
+                    break
+
+                self.directories_crawling = set(crawls_running.values())
+
+                crawls_done, _ = concurrent.futures.wait(
+                    crawls_running,
+                    timeout=1,
+                    return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                self.control_socket_poll()
+                if self.watcher is not None:
+                    self.watcher_read_changes(0)
+
+                for crawl in crawls_done:
+                    directory = crawls_running.pop(crawl)
+                    paths_total += crawl.result()
+                    self.crawl_scheduler.crawled(directory)
+                    directories_crawled.append(directory)
+        finally:
+            # E. g. a failed bulk request: dont wait for the other crawls
+            self.crawl_cancelled = len(crawls_running) > 0
+            executor.shutdown(wait=True)
+            self.directories_crawling = set()
+
+        self.print('Total paths crawled: %s' % self.format_count(paths_total))
+        self.print(
+            'Directory listings: %s (%.1f/s effective), throttled for %.2f minutes.' % (
+                self.format_count(self.crawl_throttle.listings),
+                self.crawl_throttle.effective_rate(time.time() - start_time),
+                self.crawl_throttle.duration_throttled / 60
+            )
+        )
+        self.print('Crawling done after %.2f minutes.' % ((time.time() - start_time) / 60))
+
+        self.phase = 'idle'
+        self.elasticsearch_print_stats()
+
+        self.watcher_replay_changes(directories_crawled)
+
+    def plan(self, plan_file=None):
+        """
+        Computes what an indexing run would change in the index without writing to elasticsearch
+
+        Crawls the directories like index_directories() and compares the paths with the loaded document IDs. The
+        counts are reported per directory and per exclusion, the affected paths are optionally streamed into plan_file
+        ("+" new, "~" changed, "-" deleted).
+
+        The loaded document IDs are used up (without a copy, they can take a lot of RAM): load them again for an
+        indexing run afterwards.
+        """
+
+        elasticsearch_document_ids_old = self.elasticsearch_document_ids
+        self.elasticsearch_document_ids = {}
+
+        directory_counts = {}
+        exclusion_counts = {}
+        start_time = time.time()
+
+        plan_output = None
+        if plan_file is not None:
+            # The paths may contain undecodable bytes
+            plan_output = open(plan_file, 'w', errors='surrogateescape')
+
+        try:
+            self.print('Planning the indexing run, nothing will be written to elasticsearch ...')
+
+            for directory in self.directories:
+                self.print('- Crawling directory "%s" ...' % directory)
+                counts = directory_counts[directory] = {'crawled': 0, 'new': 0, 'changed': 0, 'deleted': 0}
+
+                for root, dirs, files in self.walk_directory(directory):
+                    for entry in itertools.chain(files, dirs):
+                        full_path = entry.path
+                        exclusion = self.path_exclusion(full_path)
+                        if exclusion is not None:
+                            exclusion_counts.setdefault(exclusion, {'crawled': 0, 'deleted': 0})['crawled'] += 1
+                            continue
+
+                        fingerprint = 1
+                        if self.elasticsearch_add_additional_fields:
+                            stat = self.stat_entry(entry)
+                            if stat is None:
+                                continue
+
+                            fingerprint = self.stat_fingerprint(stat)
+
+                        counts['crawled'] += 1
+
+                        fingerprint_old = elasticsearch_document_ids_old.pop(
+                            self.elasticsearch_map_path_to_id(full_path),
+                            None
+                        )
+
+                        if fingerprint_old is None:
+                            counts['new'] += 1
+                            if plan_output is not None:
+                                plan_output.write('+ %s\n' % full_path)
+                        elif self.elasticsearch_add_additional_fields and fingerprint_old != fingerprint:
+                            counts['changed'] += 1
+                            if plan_output is not None:
+                                plan_output.write('~ %s\n' % full_path)
+
+            # The documents which weren't found: read their paths to tell where (and why) they'd be deleted
+            outside_counts = {'deleted': 0}
+            for document_id, path in self.elasticsearch_get_paths_by_ids(list(elasticsearch_document_ids_old)):
+                directory = self.crawl_scheduler.directory_of(path) if path is not None else None
+                directory_counts.get(directory, outside_counts)['deleted'] += 1
+
+                exclusion = self.path_exclusion(path) if path is not None else None
+                if exclusion is not None:
+                    exclusion_counts.setdefault(exclusion, {'crawled': 0, 'deleted': 0})['deleted'] += 1
+
+                if plan_output is not None:
+                    plan_output.write('- %s\n' % (path if path is not None else document_id))
+        finally:
+            if plan_output is not None:
+                plan_output.close()
+
+        self.print('Plan (after %.2f minutes):' % ((time.time() - start_time) / 60))
+        for directory, counts in directory_counts.items():
+            self.print(
+                '- Directory "%s": %s path(s) crawled, %s new, %s changed, %s deleted' % (
+                    directory,
+                    self.format_count(counts['crawled']),
+                    self.format_count(counts['new']),
+                    self.format_count(counts['changed']),
+                    self.format_count(counts['deleted'])
+                )
+            )
+
+        if outside_counts['deleted'] > 0:
+            self.print(
+                '- Outside of the directories: %s deleted' % self.format_count(outside_counts['deleted'])
+            )
+
+        for exclusion, counts in sorted(exclusion_counts.items()):
+            self.print(
+                '- Excluded by %s: %s path(s) crawled, %s indexed path(s) deleted' % (
+                    exclusion,
+                    self.format_count(counts['crawled']),
+                    self.format_count(counts['deleted'])
+                )
+            )
+
+        self.print(
+            'Total: %s new, %s changed, %s deleted' % (
+                self.format_count(sum(counts['new'] for counts in directory_counts.values())),
+                self.format_count(sum(counts['changed'] for counts in directory_counts.values())),
+                self.format_count(sum(counts['deleted'] for counts in directory_counts.values()) + outside_counts['deleted'])
+            )
+        )
+
+        if plan_file is not None:
+            self.print('The affected paths are listed in "%s".' % plan_file)
 
     def path_should_be_indexed(self, path, test_parent_directory):
         """ Tests if a specific path (dir or file) should be indexed """
@@ -464,18 +1502,26 @@ class Fs2EsIndexer(object):
             if not parent_dir_is_included:
                 return False
 
+        return self.path_exclusion(path) is None
+
+    def path_exclusion(self, path):
+        """ Returns a description of the first exclusion matching the path or None """
+
         for search_string in self.exclusion_strings:
             if search_string in path:
-                return False
+                return 'partial path "%s"' % search_string
 
         for search_reg_exp in self.exclusion_reg_exps:
             if re.match(search_reg_exp, path):
-                return False
+                return 'regular expression "%s"' % search_reg_exp
 
-        return True
+        return None
 
     def clear_index(self):
         """ Deletes all documents in the elasticsearch index """
+
+        import elasticsearch
+
         self.print('Deleting all documents from index "%s" ...' % self.elasticsearch_index, end='')
         try:
             if self.elasticsearch_lib_version == 7:
@@ -521,173 +1567,383 @@ class Fs2EsIndexer(object):
                 samba_audit_log_file = None
                 self.print_error('Error opening %s, cant monitor it.' % self.samba_audit_log)
 
+        self.samba_audit_log_file = samba_audit_log_file
+        samba_audit_log = SambaAuditLog(samba_audit_log_file) if samba_audit_log_file is not None else None
+
+        if self.control_socket_path is not None:
+            from lib.ControlSocket import ControlSocket
+
+            try:
+                self.control_socket = ControlSocket(self.control_socket_path, self.control_command)
+                self.print('Listening for commands on %s.' % self.control_socket_path)
+            except OSError as err:
+                self.control_socket = None
+                self.print_error('Error opening the control socket %s: %s' % (self.control_socket_path, str(err)))
+
+        if self.watcher_enabled:
+            self.watcher_start()
+
         self.elasticsearch_prepare_index()
 
         # Get all document IDs from ES and add new paths to it
         self.elasticsearch_get_all_ids()
         self.index_directories()
+        self.crawl_scheduler.crawled_all()
+        self.watcher_replay_changes(self.directories)
+        self.watcher_print_stats()
 
         while True:
-            if samba_audit_log_file is None:
-                self.print('Wont monitor Samba audit log, starting next indexing run in %s.' % self.daemon_wait_time)
-                time.sleep(self.daemon_wait_seconds)
+            wait_seconds = max(0, self.crawl_scheduler.next_crawl_at() - time.time())
+            wait_time = '%.1f min(s)' % (wait_seconds / 60)
+
+            if samba_audit_log_file is None and self.watcher is None and self.control_socket is None:
+                self.print('Wont monitor Samba audit log, starting next indexing run in %s.' % wait_time)
+                time.sleep(wait_seconds)
             else:
-                next_run_at = time.time() + self.daemon_wait_seconds
-                self.print('Monitoring Samba audit log until next indexing run in %s.' % self.daemon_wait_time)
-                self.monitor_samba_audit_log(samba_audit_log_file, next_run_at)
+                if samba_audit_log_file is not None:
+                    self.print('Monitoring Samba audit log until next indexing run in %s.' % wait_time)
+                if self.watcher is not None:
+                    self.print('Watching the directories until next indexing run in %s.' % wait_time)
+                if samba_audit_log_file is None and self.watcher is None:
+                    self.print('Waiting for commands until next indexing run in %s.' % wait_time)
+                self.monitor_changes(samba_audit_log)
+
+                if self.run_requested:
+                    self.crawl_scheduler.request_all()
+
+            self.crawl_due_directories()
+
+    def control_command(self, command, arguments):
+        """ Executes a command received via the control socket and returns the response """
+
+        if command == 'stats':
+            stats = [
+                'phase: %s' % self.phase,
+                'crawling paused: %s' % ('yes' if self.crawl_paused else 'no'),
+                'document IDs: %s' % self.format_count(len(self.elasticsearch_document_ids)),
+                'queued reindexes: %d' % len(self.paths_to_reindex),
+                'directory listings (current / last run): %s' % self.format_count(self.crawl_throttle.listings),
+            ]
+
+            if self.samba_audit_log_file is not None:
+                try:
+                    audit_log_lag = os.fstat(self.samba_audit_log_file.fileno()).st_size - self.samba_audit_log_file.tell()
+                    stats.append('audit log lag: %s byte(s)' % self.format_count(max(0, audit_log_lag)))
+                except (OSError, ValueError):
+                    pass
 
-            self.index_directories()
+                if self.samba_audit_log_read_at is not None:
+                    stats.append('last audit log line: %d sec(s) ago' % (time.time() - self.samba_audit_log_read_at))
 
-    def monitor_samba_audit_log(self, samba_audit_log_file, stop_at):
-        """ Monitors the given file descriptor for changes until the time stop_at is reached. """
+            if self.watcher is not None:
+                stats.append('inotify watches: %s' % self.format_count(len(self.watcher.watches)))
 
-        while time.time() <= stop_at:
-            line = samba_audit_log_file.readline()
-            if not line:
-                # Nothing new in the audit log - sleep for 5 seconds
+            for directory_summary in self.crawl_scheduler.summary():
+                stats.append('directory %s' % directory_summary)
 
-                time.sleep(self.samba_monitor_sleep_time)
-                continue
+            stats.append(
+                'elasticsearch documents (current / last run): %s written, %s failed' % (
+                    self.format_count(self.elasticsearch_documents_written),
+                    self.format_count(self.elasticsearch_documents_failed)
+                )
+            )
 
-            self.print_verbose('* Got new line: "%s"' % line.strip())
+            for node_summary in self.elasticsearch_node_stats.summary():
+                stats.append('elasticsearch node %s' % node_summary)
 
-            re_match = re.match(r'^.*\|(openat|unlinkat|renameat|mkdirat)\|ok\|(.*)$', line)
-            if re_match:
-                # create a file:       <user>|<ip>|openat|ok|w|<path> (w!)
-                # rename a file / dir: <user>|<ip>|renameat|ok|<source>|<target>
-                # create a dir:        <user>|<ip>|mkdirat|ok|<path>
-                # delete a file / dir: <user>|<ip>|unlinkat|ok|<path>
+            return '\n'.join(stats)
 
-                operation = re_match.group(1)
-                values = re_match.group(2).split('|')
+        elif command == 'reindex':
+            if arguments == '':
+                return 'Error: "reindex" requires a path'
 
-                if len(values) == 0:
-                    if self.print_verbose:
-                        self.print_verbose('*- not interested: no values?!')
-                    continue
+            path = os.path.normpath(arguments)
+            if not self.path_should_be_indexed(path, True):
+                return 'Error: "%s" is not below the configured directories or excluded' % path
 
-                # So we can use pop(), because python has no array_shift()!
-                values.reverse()
+            if self.phase in ('crawling', 'reindexing'):
+                self.paths_to_reindex.append(path)
+                return 'Queued the reindex of "%s", it will start after the current %s.' % (
+                    path,
+                    'indexing run' if self.phase == 'crawling' else 'reindex'
+                )
 
-                path_to_import = None
-                path_to_delete = None
+            self.reindex_path(path)
+            return 'Reindexed "%s".' % path
 
-                if operation == 'openat':
-                    # openat has another value "r" or "w", we only want to react to "w"
-                    openat_operation = values.pop()
-                    if openat_operation == 'w':
-                        path_to_import = values.pop()
-                    else:
-                        self.print_verbose('*- not interested: expected openat with w, but got "%s"' % openat_operation)
-
-                elif operation == 'renameat':
-                    source_path = values.pop()
-                    target_path = values.pop()
-
-                    if ':' in source_path:
-                        # We ignore these paths BECAUSE if you delete a xattr from a file, we don't want to delete the
-                        # whole file from index.
-                        # This should not happen for a renameat, but oh well...
-                        continue
+        elif command == 'pause':
+            self.crawl_paused = True
+            return 'Crawling paused.'
 
-                    # If path_to_delete WAS a directory, we have to move all files and subdirectories BELOW it too.
-                    resp = self.search(source_path)
-                    for hit in resp['hits']['hits']:
-                        # Each of these documents got moved from source_path to target_path!
+        elif command == 'resume':
+            self.crawl_paused = False
+            return 'Crawling resumed.'
 
-                        hit_old_path = hit['_source']['path']['real']
-                        self.print_verbose('*- delete "%s"' % hit_old_path)
-                        document_id_old = self.elasticsearch_map_path_to_id(hit_old_path)
+        elif command == 'run':
+            if self.phase == 'crawling':
+                return 'An indexing run is already in progress.'
 
-                        try:
-                            del self.elasticsearch_document_ids[document_id_old]
-                        except:
-                            # If the key was already deleted - thats ok!
-                            pass
+            self.run_requested = True
+            return 'Starting an indexing run now.'
 
-                        try:
-                            self.elasticsearch.delete(
-                                index=self.elasticsearch_index,
-                                id=document_id_old
-                            )
-                        except elasticsearch.NotFoundError:
-                            # That's OK, we wanted to delete it anyway
-                            pass
-
-                        hit_new_path = hit_old_path.replace(source_path, target_path, 1)
-                        self.print_verbose('*- import "%s"' % hit_new_path)
-                        document = self.elasticsearch_map_path_to_document(
-                            path=hit_new_path,
-                            filename=os.path.basename(hit_new_path)
-                        )
+        return 'Unknown command "%s", allowed are "stats", "reindex <path>", "pause", "resume" or "run".' % command
 
-                        self.elasticsearch_document_ids[document['_id']] = 1
+    def control_socket_poll(self, timeout=0):
+        """ Executes the commands waiting on the control socket """
 
-                        self.elasticsearch.index(
-                            index=self.elasticsearch_index,
-                            id=document['_id'],
-                            document=document['_source']
-                        )
+        if self.control_socket is None:
+            if timeout > 0:
+                time.sleep(timeout)
+            return
 
-                elif operation == 'mkdirat':
-                    path_to_import = values.pop()
-                elif operation == 'unlinkat':
-                    path_to_delete = values.pop()
-                else:
-                    self.print_verbose('*- not interested: unrecognized operation: %s' % operation)
-                    continue
+        self.control_socket_polled_at = time.monotonic()
+        self.control_socket.poll(timeout)
 
-                if path_to_import is not None:
-                    # The path can have a suffix! These are the xattr... ignore them completely
-                    if ':' in path_to_import:
-                        continue
+    def watcher_start(self):
+        """ Starts the watcher and watches the directories, their subdirectories are watched by their next crawl """
 
-                    if self.path_should_be_indexed(path_to_import, True):
-                        self.print_verbose('*- import "%s"' % path_to_import)
+        from lib.InotifyWatcher import InotifyWatcher
 
-                        document = self.elasticsearch_map_path_to_document(
-                            path=path_to_import,
-                            filename=os.path.basename(path_to_import)
-                        )
+        try:
+            self.watcher = InotifyWatcher(
+                self.watcher_max_watches,
+                lambda path: self.path_should_be_indexed(path, False),
+                self.elasticsearch_add_additional_fields
+            )
+        except (OSError, AttributeError) as err:
+            # AttributeError: the libc has no inotify functions (e. g. not running on Linux)
+            self.watcher = None
+            self.print_error('Error initializing inotify, cant watch the directories: %s' % str(err))
+            return
 
-                        self.elasticsearch_document_ids[document['_id']] = 1
+        for directory in self.directories:
+            self.watcher.add_root(directory)
 
-                        self.elasticsearch.index(
-                            index=self.elasticsearch_index,
-                            id=document['_id'],
-                            document=document['_source']
-                        )
+        self.print('The inotify watches of the subdirectories are registered during the first indexing run.')
 
-                if path_to_delete is not None:
-                    # The path can have a suffix! These are the xattr... ignore them completely
-                    if ':' in path_to_delete:
-                        # We ignore these paths BECAUSE if you delete a xattr from a file, we don't want to delete the
-                        # whole file from index.
-                        continue
+    def watcher_print_stats(self):
+        """ Prints the amount of inotify watches, e. g. after the first indexing run registered them """
 
-                    if self.path_should_be_indexed(path_to_delete, True):
-                        self.print_verbose('*- delete "%s"' % path_to_delete)
+        if self.watcher is None:
+            return
 
-                        document_id_old = self.elasticsearch_map_path_to_id(path_to_delete)
+        self.print('Registered %s inotify watch(es).' % self.format_count(len(self.watcher.watches)))
 
-                        try:
-                            del self.elasticsearch_document_ids[document_id_old]
-                        except:
-                            # If the key was already deleted - thats ok!
-                            pass
+        if self.watcher.watch_limit_reached:
+            self.print_error(
+                'Reached the limit of inotify watches: some directories will only be updated by the indexing runs. '
+                'Raise "watcher.max_watches" and the sysctl "fs.inotify.max_user_watches" to watch all directories.'
+            )
 
-                        try:
-                            self.elasticsearch.delete(
-                                index=self.elasticsearch_index,
-                                id=document_id_old
-                            )
-                        except elasticsearch.NotFoundError:
-                            # That's OK, we wanted to delete it anyway
-                            pass
+    def watcher_replay_changes(self, directories_crawled):
+        """
+        Pushes the watcher events that piled up during an indexing run of the directories into elasticsearch
+
+        The crawler may have listed a directory before a change in it happened, so the events can't be dropped. Imports
+        and deletes are idempotent: replaying the changes the crawler already picked up doesn't hurt.
+        """
+
+        if self.watcher is None:
+            return
+
+        # The events still queued arrived during the run
+        self.directories_crawling = set(directories_crawled)
+        self.monitor_watcher(0)
+        self.directories_crawling = set()
+
+    def watcher_read_changes(self, timeout):
+        """
+        Waits up to timeout seconds for changes from the watcher and collects them until monitor_watcher() applies them
+
+        Called during the crawls too: the kernel drops all events if its queue (fs.inotify.max_queued_events) is full.
+        """
+
+        self.watcher_read_at = time.monotonic()
+        paths_to_import, paths_to_delete, paths_to_rescan = self.watcher.read_changes(timeout)
+
+        # Each path is only in one of the lists, the later reads win
+        for path in paths_to_import:
+            self.watcher_paths_changed[path] = True
+        for path in paths_to_delete:
+            self.watcher_paths_changed[path] = False
+
+        for path in paths_to_rescan:
+            if path in self.crawl_scheduler.schedules:
+                # The watcher lost events (overflow): leave the crawl of the whole directory to the scheduler. If the
+                # directory is crawled right now, this crawl picks up most of them: dont start the next one right away.
+                self.watcher_directories_to_crawl[path] = (
+                    self.watcher_directories_to_crawl.get(path, False) or path not in self.directories_crawling
+                )
             else:
-                self.print_verbose('*- not interested: regexp didnt match')
+                self.watcher_paths_to_rescan.add(path)
+
+    def monitor_watcher(self, timeout):
+        """ Pushes the collected changes of the watcher and the ones arriving within timeout seconds into elasticsearch """
+
+        self.watcher_read_changes(timeout)
+
+        paths_changed = self.watcher_paths_changed
+        paths_to_rescan = self.watcher_paths_to_rescan
+        directories_to_crawl = self.watcher_directories_to_crawl
+        self.watcher_paths_changed = {}
+        self.watcher_paths_to_rescan = set()
+        self.watcher_directories_to_crawl = {}
+
+        paths_to_import = [
+            path for path, is_import in paths_changed.items() if is_import and self.path_should_be_indexed(path, True)
+        ]
+        paths_to_delete = [
+            path for path, is_import in paths_changed.items() if not is_import and self.path_should_be_indexed(path, True)
+        ]
+
+        for path in itertools.chain(paths_to_import, paths_to_delete):
+            self.crawl_scheduler.mark_dirty(path)
+
+        self.elasticsearch_live_update(paths_to_import, paths_to_delete)
+
+        for directory, force in directories_to_crawl.items():
+            self.crawl_scheduler.mark_dirty(directory, force=force)
+
+        for path in paths_to_rescan:
+            if self.path_should_be_indexed(path, True):
+                self.crawl_scheduler.mark_dirty(path)
+                self.reindex_path(path)
+
+    def monitor_changes(self, samba_audit_log):
+        """ Monitors the given SambaAuditLog and / or the watcher for changes until the scheduler has a due directory """
+
+        self.phase = 'waiting'
+        self.run_requested = False
+
+        while time.time() < self.crawl_scheduler.next_crawl_at() and not self.run_requested:
+            while len(self.paths_to_reindex) > 0:
+                self.reindex_path(self.paths_to_reindex.pop(0))
+
+            lines = None
+            if samba_audit_log is not None:
+                lines = samba_audit_log.read_lines()
+
+            if not lines:
+                # Nothing new in the audit log - wait for the watcher or sleep
+                if self.watcher is not None:
+                    self.control_socket_poll()
+                    self.monitor_watcher(self.samba_monitor_sleep_time)
+                else:
+                    self.control_socket_poll(self.samba_monitor_sleep_time)
+                continue
+
+            self.samba_audit_log_read_at = time.time()
+            self.monitor_samba_audit_log_lines(lines)
+
+            # Dont let a busy audit log starve the watcher and the control socket
+            self.control_socket_poll()
+            if self.watcher is not None:
+                self.monitor_watcher(0)
+
+    def monitor_samba_audit_log_lines(self, lines):
+        """ Pushes the changes of the given samba audit log lines into elasticsearch in as few requests as possible """
+
+        # Ordered by first appearance, the last operation on a path wins
+        paths_to_import = {}
+        paths_to_delete = {}
+
+        for line in lines:
+            if self.verbose_messages:
+                self.print_verbose('* Got new line: "%s"', line.strip())
+
+            parsed_line = SambaAuditLog.parse_line(line)
+            if parsed_line is None:
+                self.print_verbose('*- not interested')
+                continue
+
+            operation, values = parsed_line
+
+            if operation == 'openat':
+                # openat has another value "r" or "w", we only want to react to "w"
+                if len(values) < 2 or values[0] != 'w':
+                    self.print_verbose('*- not interested: expected openat with w, but got "%s"', values[0])
+                    continue
+
+                path_to_import = values[1]
+                path_to_delete = None
+
+            elif operation == 'renameat':
+                if len(values) < 2:
+                    self.print_verbose('*- not interested: expected source and target')
+                    continue
+
+                source_path = values[0]
+                target_path = values[1]
+
+                if ':' in source_path:
+                    # We ignore these paths BECAUSE if you delete a xattr from a file, we don't want to delete the
+                    # whole file from index.
+                    # This should not happen for a renameat, but oh well...
+                    continue
+
+                # The move works on the documents in elasticsearch: write everything before it
+                source_path_imported = source_path in paths_to_import
+                self.monitor_samba_audit_log_flush(paths_to_import, paths_to_delete)
+
+                self.crawl_scheduler.mark_dirty(source_path)
+                self.crawl_scheduler.mark_dirty(target_path)
+
+                # If source_path WAS a directory, we have to move all files and subdirectories BELOW it too.
+                documents_moved = self.elasticsearch_move_subtree(source_path, target_path)
+
+                if source_path_imported or documents_moved == 0:
+                    # A path imported a moment ago isn't visible to searches yet (e. g. office saves a temp file and
+                    # renames it): move it by ID
+                    self.elasticsearch_live_update(
+                        [target_path] if self.path_should_be_indexed(target_path, True) else [],
+                        [source_path]
+                    )
                 continue
 
+            elif operation == 'mkdirat':
+                path_to_import = values[0]
+                path_to_delete = None
+            else:
+                # unlinkat
+                path_to_import = None
+                path_to_delete = values[0]
+
+            # The path can have a suffix! These are the xattr... ignore them completely
+            # We ignore these paths BECAUSE if you delete a xattr from a file, we don't want to delete the
+            # whole file from index.
+            if path_to_import is not None and ':' not in path_to_import:
+                if self.path_should_be_indexed(path_to_import, True):
+                    paths_to_import[path_to_import] = True
+
+            if path_to_delete is not None and ':' not in path_to_delete:
+                if self.path_should_be_indexed(path_to_delete, True):
+                    # The deletes are written before the imports: drop the imports they'd undo
+                    prefix = path_to_delete + os.sep
+                    for path in [path for path in paths_to_import if path == path_to_delete or path.startswith(prefix)]:
+                        del paths_to_import[path]
+
+                    paths_to_delete[path_to_delete] = True
+
+        self.monitor_samba_audit_log_flush(paths_to_import, paths_to_delete)
+
+    def monitor_samba_audit_log_flush(self, paths_to_import, paths_to_delete):
+        """ Writes (and clears) the collected changes of the samba audit log: first the deletes, then the imports """
+
+        for path in itertools.chain(paths_to_delete, paths_to_import):
+            self.crawl_scheduler.mark_dirty(path)
+
+        if len(paths_to_delete) > 0:
+            # Deleted by ID: a path imported a moment ago isn't visible to searches yet (e. g. office temp files)
+            self.elasticsearch_live_update([], list(paths_to_delete))
+
+            # The paths may have been directories: delete everything below them too
+            self.elasticsearch_delete_subtrees(list(paths_to_delete), below_only=True)
+            paths_to_delete.clear()
+
+        if len(paths_to_import) > 0:
+            self.elasticsearch_live_update(list(paths_to_import), [])
+            paths_to_import.clear()
+
     def search(self, search_path, search_term=None, search_filename=None):
         """
         Searches for a specific term in the ES index
@@ -702,6 +1958,8 @@ class Fs2EsIndexer(object):
         Enable logging all queries as "slow query" see enable_slowlog() and look into your slow-log-files.
         """
 
+        import elasticsearch
+
         if search_term is not None:
             query = {
                 "query_string": {
@@ -752,21 +2010,32 @@ class Fs2EsIndexer(object):
 
     def elasticsearch_get_all_ids(self):
         """ Reads all document IDs from elasticsearch """
+
+        import elasticsearch
+
         self.print('Loading all document IDs from elasticsearch...')
 
         resp = None
         start_time = time.time()
 
+        if self.elasticsearch_add_additional_fields:
+            # Load the fields for the fingerprints too
+            source_fields = {"_source": ["file.filesize", "file.last_modified"]}
+        else:
+            source_fields = {"stored_fields": []}
+
         try:
             if self.elasticsearch_lib_version == 7:
                 resp = self.elasticsearch.search(
                     index=self.elasticsearch_index,
-                    body={
-                        "query": {
-                            "match_all": {}
-                        }
-                    },
-                    stored_fields=[],
+                    body=dict(
+                        {
+                            "query": {
+                                "match_all": {}
+                            }
+                        },
+                        **source_fields
+                    ),
                     size=self.elasticsearch_bulk_size,
                     scroll='1m'
                 )
@@ -776,9 +2045,9 @@ class Fs2EsIndexer(object):
                     query={
                         "match_all": {}
                     },
-                    stored_fields=[],
                     size=self.elasticsearch_bulk_size,
-                    scroll='1m'
+                    scroll='1m',
+                    **source_fields
                 )
         except elasticsearch.exceptions.ConnectionError as err:
             self.print_error('Failed to connect to elasticsearch at "%s": %s' % (self.elasticsearch_url, str(err)))
@@ -795,7 +2064,10 @@ class Fs2EsIndexer(object):
 
         while len(resp['hits']['hits']) > 0:
             for document in resp['hits']['hits']:
-                self.elasticsearch_document_ids[document['_id']] = 1
+                if self.elasticsearch_add_additional_fields:
+                    self.elasticsearch_document_ids[document['_id']] = self.source_fingerprint(document.get('_source', {}))
+                else:
+                    self.elasticsearch_document_ids[document['_id']] = 1
 
             self.print_verbose('- Calling es.scroll() with ID "%s"' % resp['_scroll_id'])
 
@@ -875,10 +2147,14 @@ class Fs2EsIndexer(object):
 
         self.print('Slowlog for slow queries only enabled. Only queries that are slow enough are logged to the slowlog again.')
 
-    def print_verbose(self, message, end='\n'):
-        """ Prints the given message onto the console and preprends the current datetime IF VERBOSE printing is enabled """
+    def print_verbose(self, message, *args, end='\n'):
+        """
+        Prints the given message onto the console and preprends the current datetime IF VERBOSE printing is enabled
+
+        The message is only formatted with the args if it's printed, so pass them instead of formatting beforehand.
+        """
         if self.verbose_messages:
-            self.print(message, end)
+            self.print(message % args if args else message, end)
 
     @staticmethod
     def print(message, end='\n'):
@@ -0,0 +1,252 @@
+#-*- coding: utf-8 -*-
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+
+
+class InotifyWatcher(object):
+    """ Watches directory trees via the Linux inotify API and translates the events into index changes """
+
+    # See "man 7 inotify" for these constants
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_DONT_FOLLOW = 0x02000000
+    IN_EXCL_UNLINK = 0x04000000
+    IN_ISDIR = 0x40000000
+
+    WATCH_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, max_watches, path_filter, watch_modifications=False):
+        """
+        Constructor
+
+        max_watches limits the amount of watched directories, path_filter(path) decides if a directory should be
+        watched at all (e. g. to honor the exclusions). With watch_modifications modified files are reported as
+        paths to import too, e. g. to update their metadata.
+        """
+
+        self.max_watches = max_watches
+        self.watch_mask = self.WATCH_MASK
+        if watch_modifications:
+            self.watch_mask |= self.IN_CLOSE_WRITE
+
+        self.path_filter = path_filter
+        self.watch_limit_reached = False
+
+        # The crawls may add watches in threads (see watch_missing()) while the events are read
+        self.lock = threading.RLock()
+
+        # Maps the watch descriptors to the watched directory paths and vice versa
+        self.watches = {}
+        self.watched_paths = {}
+        self.roots = []
+
+        # Paths whose subtrees have to be compared with the index, because we may have missed events in them
+        self.paths_to_rescan = set()
+
+        # Roots which lost events (queue overflow): the crawl of the root adds their missing watches, see watch_missing()
+        self.roots_to_rewatch = set()
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, 'inotify_init1 failed: %s' % os.strerror(err))
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_root(self, directory):
+        """
+        Watches the given directory, its subdirectories are watched during its next crawl (see watch_missing())
+
+        Walking the directory here would be an extra (unthrottled) crawl of the storage.
+        """
+
+        self.roots.append(directory)
+        self.roots_to_rewatch.add(directory)
+        return self.add_watch(directory)
+
+    def add_tree(self, directory):
+        """ Watches the given directory and all of its subdirectories, returns the amount of new watches """
+
+        watches_added = 0
+        stack = [directory]
+        while stack:
+            path = stack.pop()
+            if path not in self.watched_paths:
+                if not self.add_watch(path):
+                    if self.watch_limit_reached:
+                        # Everything below stays unwatched and will only be updated by the regular indexing runs
+                        break
+                    continue
+
+                watches_added += 1
+
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks=False) and self.path_filter(entry.path):
+                                stack.append(entry.path)
+                        except OSError:
+                            pass
+            except OSError:
+                # The directory vanished or is not readable - its parent will tell us about it
+                pass
+
+        return watches_added
+
+    def add_watch(self, path):
+        """ Adds a single inotify watch for the given directory """
+
+        with self.lock:
+            if len(self.watches) >= self.max_watches:
+                self.watch_limit_reached = True
+                return False
+
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.watch_mask)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    # The kernel limit fs.inotify.max_user_watches is reached
+                    self.watch_limit_reached = True
+                return False
+
+            self.watches[wd] = path
+            self.watched_paths[path] = wd
+            return True
+
+    def watch_missing(self, directory):
+        """ Adds the watch of a directory listed by a crawl, if its root lost events and it isn't watched (anymore) """
+
+        if not self.roots_to_rewatch or directory in self.watched_paths or self.watch_limit_reached:
+            return
+
+        # A copy: the crawls of other roots may run in threads and call rewatched() meanwhile
+        for root in tuple(self.roots_to_rewatch):
+            if directory == root or directory.startswith(root + os.sep):
+                if self.path_filter(directory):
+                    self.add_watch(directory)
+                return
+
+    def rewatched(self, root):
+        """ Records that a crawl of the root went through all of its directories, see watch_missing() """
+
+        self.roots_to_rewatch.discard(root)
+
+    def remove_tree(self, directory):
+        """ Removes the watches of the given directory and all of its subdirectories """
+
+        prefix = directory + os.sep
+        with self.lock:
+            for path in [p for p in self.watched_paths if p == directory or p.startswith(prefix)]:
+                wd = self.watched_paths.pop(path)
+                del self.watches[wd]
+                self.libc.inotify_rm_watch(self.fd, wd)
+
+            if self.watch_limit_reached and len(self.watches) < self.max_watches:
+                self.watch_limit_reached = False
+
+    def mark_for_rescan(self, path):
+        """ Marks the subtree of the given path as possibly out of sync with the index """
+
+        for rescan_path in list(self.paths_to_rescan):
+            if path == rescan_path or path.startswith(rescan_path + os.sep):
+                # A parent is already marked
+                return
+            if rescan_path.startswith(path + os.sep):
+                self.paths_to_rescan.discard(rescan_path)
+
+        self.paths_to_rescan.add(path)
+
+    def read_changes(self, timeout):
+        """
+        Waits up to timeout seconds for events and returns the resulting changes as a tuple
+        (paths_to_import, paths_to_delete, paths_to_rescan). Only the last event of a path counts.
+        """
+
+        changes = {}
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        while readable:
+            try:
+                buffer = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(buffer, offset)
+                offset += self.EVENT_HEADER.size
+                name = buffer[offset:offset + length].rstrip(b'\0')
+                offset += length
+
+                self.handle_event(wd, mask, os.fsdecode(name), changes)
+
+        paths_to_rescan = list(self.paths_to_rescan)
+        self.paths_to_rescan = set()
+
+        return (
+            [path for path, is_import in changes.items() if is_import],
+            [path for path, is_import in changes.items() if not is_import],
+            paths_to_rescan
+        )
+
+    def handle_event(self, wd, mask, name, changes):
+        """ Translates one inotify event into changes """
+
+        if mask & self.IN_Q_OVERFLOW:
+            # The kernel dropped events: we can't know what changed and may have missed new directories. Walking the
+            # roots here would be an unthrottled crawl, their (throttled) crawls add the missing watches instead.
+            for root in self.roots:
+                self.roots_to_rewatch.add(root)
+                self.mark_for_rescan(root)
+            return
+
+        if mask & self.IN_IGNORED:
+            # The watch was removed (directory deleted, moved away or unmounted)
+            with self.lock:
+                path = self.watches.pop(wd, None)
+                if path is not None and self.watched_paths.get(path) == wd:
+                    del self.watched_paths[path]
+            return
+
+        directory = self.watches.get(wd)
+        if directory is None or not name:
+            return
+
+        path = os.path.join(directory, name)
+
+        if mask & self.IN_ISDIR:
+            # The index may contain (or miss) a whole subtree below this directory
+            if mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                self.remove_tree(path)
+            elif mask & (self.IN_CREATE | self.IN_MOVED_TO) and self.path_filter(path):
+                self.add_tree(path)
+
+            changes.pop(path, None)
+            self.mark_for_rescan(path)
+        elif mask & (self.IN_CREATE | self.IN_MOVED_TO | self.IN_CLOSE_WRITE):
+            changes[path] = True
+        elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+            changes[path] = False
@@ -0,0 +1,64 @@
+#-*- coding: utf-8 -*-
+
+import threading
+import time
+
+
+class NodeLatencyStats(object):
+    """ Collects the amount and latency of the requests per elasticsearch node (thread safe for the bulk workers) """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.nodes = {}
+
+    def record(self, node, duration, failed=False):
+        """ Records one request to the given node (its base URL) """
+
+        with self.lock:
+            stats = self.nodes.get(node)
+            if stats is None:
+                stats = self.nodes[node] = {'requests': 0, 'failed': 0, 'duration': 0.0, 'max_duration': 0.0}
+
+            stats['requests'] += 1
+            stats['duration'] += duration
+            stats['max_duration'] = max(stats['max_duration'], duration)
+            if failed:
+                stats['failed'] += 1
+
+    def reset(self):
+        with self.lock:
+            self.nodes = {}
+
+    def summary(self):
+        """ Returns one line per node """
+
+        with self.lock:
+            return [
+                '%s: %d request(s), %d failed, %.1f ms average, %.1f ms max' % (
+                    node,
+                    stats['requests'],
+                    stats['failed'],
+                    stats['duration'] / stats['requests'] * 1000,
+                    stats['max_duration'] * 1000
+                )
+                for node, stats in sorted(self.nodes.items())
+            ]
+
+    def node_class(self, base_class):
+        """ Returns a subclass of the node (v8) / connection (v7) class of the elasticsearch library recording into self """
+
+        stats = self
+
+        class LatencyRecordingNode(base_class):
+            def perform_request(self, *args, **kwargs):
+                start_time = time.monotonic()
+                failed = True
+                try:
+                    response = super().perform_request(*args, **kwargs)
+                    failed = False
+                    return response
+                finally:
+                    # v8 nodes know their "base_url", v7 connections their "host"
+                    stats.record(getattr(self, 'base_url', None) or self.host, time.monotonic() - start_time, failed)
+
+        return LatencyRecordingNode
@@ -0,0 +1,56 @@
+#-*- coding: utf-8 -*-
+
+import re
+
+
+class SambaAuditLog(object):
+    """
+    Reads and parses the samba audit log (vfs module "full_audit") in batches
+
+    The lines we're interested in:
+    - create a file:       <user>|<ip>|openat|ok|w|<path> (w!)
+    - rename a file / dir: <user>|<ip>|renameat|ok|<source>|<target>
+    - create a dir:        <user>|<ip>|mkdirat|ok|<path>
+    - delete a file / dir: <user>|<ip>|unlinkat|ok|<path>
+    """
+
+    LINE_PATTERN = re.compile(r'\|(openat|unlinkat|renameat|mkdirat)\|ok\|(.*)$')
+
+    def __init__(self, file, batch_size=1048576):
+        """ Constructor, batch_size is the (approximate) amount of bytes read per call """
+
+        self.file = file
+        self.batch_size = batch_size
+
+        # The start of a line which wasnt completely written yet
+        self.incomplete_line = ''
+
+    def read_lines(self):
+        """ Returns all complete new lines (up to batch_size bytes) """
+
+        lines = self.file.readlines(self.batch_size)
+        if not lines:
+            return lines
+
+        if self.incomplete_line:
+            lines[0] = self.incomplete_line + lines[0]
+            self.incomplete_line = ''
+
+        if not lines[-1].endswith('\n'):
+            self.incomplete_line = lines.pop()
+
+        return lines
+
+    @classmethod
+    def parse_line(cls, line):
+        """ Returns (operation, values) of an interesting line or None """
+
+        # Cheap tests first: failed operations and reading openat's (the bulk of the log) are not interesting
+        if '|ok|' not in line or '|openat|ok|r|' in line:
+            return None
+
+        re_match = cls.LINE_PATTERN.search(line)
+        if re_match is None:
+            return None
+
+        return re_match.group(1), re_match.group(2).split('|')